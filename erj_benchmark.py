@@ -0,0 +1,244 @@
+'''Synthetic election data and benchmarks for the erj_toolbox functions.
+Runs offline - every dataset is generated locally from a seed.
+
+Ex:
+    python erj_benchmark.py                            compare against benchmark_baseline.json, exit 1 on a regression
+    python erj_benchmark.py --sizes small medium       only some sizes
+    python erj_benchmark.py --update-baseline          record the current timings as the new baseline
+Timings depend on the machine, so update the baseline on the machine the comparison runs on.
+'''
+
+import os
+import sys
+import io
+import json
+import time
+import warnings
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+import erj_toolbox as et
+
+#Dataset sizes to benchmark - name: make_synthetic_state arguments
+BENCHMARK_SIZES = {'small': {'n_precincts': 500, 'n_counties': 10, 'n_races': 20},
+                   'medium': {'n_precincts': 5000, 'n_counties': 50, 'n_races': 100},
+                   'large': {'n_precincts': 10000, 'n_counties': 100, 'n_races': 200}}
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+def make_synthetic_state(n_precincts=1000, n_counties=20, n_races=20, n_con=4, n_su=10, n_sl=20, split_rate=.02,
+                         write_in_rate=.05, diff_rate=.01, with_geometry=True, seed=0):
+    '''Purpose: generate a synthetic state's election data in the shapes the toolbox works with
+
+    Arguments:
+        n_precincts, n_counties: number of precincts and counties (precincts are spread over the counties in blocks)
+        n_races: number of statewide vote columns (G20ST001 ...), on top of two candidates per CON/SU/SL district
+        n_con, n_su, n_sl: number of districts per level
+        split_rate: share of precincts that also have CON votes in the next district (split precincts)
+        write_in_rate: share of the long-format SOS rows that are write-ins
+        diff_rate: share of precinct vote cells where the source results differ from VEST
+        with_geometry: add a square polygon per precinct and the official/assigned district layers (needs geopandas)
+        seed: random seed, the same arguments always give the same data
+
+    Returns dictionary with:
+        partner_df: VEST-style ERJ frame - UNIQUE_ID, COUNTYFP, CONG_DIST, SLDU_DIST, SLDL_DIST, then the vote columns
+        source_df: the same precincts with a few differences, as the SOS results would have
+        merged_df: partner_df merged with source_df on UNIQUE_ID (_x/_y vote columns)
+        allocating_df: county-level absentee votes to allocate to the precincts
+        sos_long_df: long-format SOS results (one row per precinct x contest x candidate) for create_field_id
+        column_list, district_columns: the statewide and district vote columns
+        split_precincts: UNIQUE_IDs of the split precincts
+        precinct_gdf, official_gdf, assigned_gdf: only with_geometry - precinct squares and two versions of the CON districts
+    '''
+
+    rng = np.random.default_rng(seed)
+    counties = np.array(['{:03d}'.format(2*i+1) for i in range(n_counties)], dtype=object)
+    county = counties[np.arange(n_precincts)*n_counties//n_precincts]
+    unique_id = np.array([c+'-'+'{:05d}'.format(i) for i, c in enumerate(county)], dtype=object)
+    districts = {level: np.arange(n_precincts)*n//n_precincts+1 for level, n in (('CON', n_con), ('SU', n_su), ('SL', n_sl))}
+
+    partner_df = pd.DataFrame({'UNIQUE_ID': unique_id, 'COUNTYFP': county,
+                               'CONG_DIST': ['{:02d}'.format(d) for d in districts['CON']],
+                               'SLDU_DIST': ['{:02d}'.format(d) for d in districts['SU']],
+                               'SLDL_DIST': ['{:03d}'.format(d) for d in districts['SL']]})
+    column_list = ['G20ST{:03d}'.format(j) for j in range(n_races)]
+    votes = {col: rng.integers(0, 400, n_precincts) for col in column_list}
+    district_columns = []
+    split = rng.random(n_precincts) < split_rate
+    for level, zfill, n in (('CON', 2, n_con), ('SU', 2, n_su), ('SL', 3, n_sl)):
+        for d in range(1, n+1):
+            in_district = districts[level] == d
+            if level == 'CON':
+                #Split precincts also get votes in the next congressional district
+                in_district = in_district | (split & (districts[level] == d-1))
+            for candidate in ('DSMI', 'RJON'):
+                col = 'G'+level+str(d).zfill(zfill)+candidate
+                votes[col] = np.where(in_district, rng.integers(0, 300, n_precincts), 0)
+                district_columns.append(col)
+    partner_df = pd.concat([partner_df, pd.DataFrame(votes)], axis=1)
+
+    source_df = partner_df.copy()
+    vote_cols = column_list+district_columns
+    vote_values = source_df[vote_cols].to_numpy()
+    changed = (rng.random(vote_values.shape) < diff_rate) & (vote_values > 5)
+    vote_values[changed] += rng.integers(-5, 6, changed.sum())
+    source_df[vote_cols] = vote_values
+    merged_df = partner_df.merge(source_df.drop(columns=['COUNTYFP', 'CONG_DIST', 'SLDU_DIST', 'SLDL_DIST']), on='UNIQUE_ID')
+
+    allocating_df = pd.DataFrame({'COUNTYFP': counties})
+    allocating_df = pd.concat([allocating_df, pd.DataFrame(rng.integers(0, 2000, (n_counties, n_races)), columns=column_list)], axis=1)
+
+    #Long-format SOS results: every precinct votes in the statewide contests and its own CON, SU and SL contests
+    #(the proposition number is in the party column, use prop_number='party' with create_field_id)
+    contests = [('President of the United States', 'D', 'BID'), ('President of the United States', 'R', 'TRU'),
+                ('U.S. Senator', 'D', 'KEL'), ('U.S. Senator', 'R', 'MCS'), ('Proposition 207', '207', 'YES'),
+                ('U.S. Representative in Congress', 'D', 'SMI'), ('U.S. Representative in Congress', 'R', 'JON'),
+                ('State Senator', 'D', 'SMI'), ('State Senator', 'R', 'JON'),
+                ('State Representative', 'D', 'SMI'), ('State Representative', 'R', 'JON')]
+    precinct_row = np.repeat(np.arange(n_precincts), len(contests))
+    contest_row = np.tile(np.arange(len(contests)), n_precincts)
+    sos_long_df = pd.DataFrame({'precinct': unique_id[precinct_row],
+                                'contest': np.array([c[0] for c in contests], dtype=object)[contest_row],
+                                'party': np.array([c[1] for c in contests], dtype=object)[contest_row],
+                                'choice': np.array([c[2] for c in contests], dtype=object)[contest_row],
+                                'usrep_dist': partner_df['CONG_DIST'].to_numpy()[precinct_row],
+                                'sldu_dist': partner_df['SLDU_DIST'].to_numpy()[precinct_row],
+                                'sldl_dist': partner_df['SLDL_DIST'].to_numpy()[precinct_row],
+                                'is_write_in': np.where(rng.random(len(precinct_row)) < write_in_rate, 'true', 'false'),
+                                'votes': rng.integers(0, 400, len(precinct_row))})
+
+    data = {'partner_df': partner_df, 'source_df': source_df, 'merged_df': merged_df, 'allocating_df': allocating_df,
+            'sos_long_df': sos_long_df, 'column_list': column_list, 'district_columns': district_columns,
+            'split_precincts': list(unique_id[split])}
+    if with_geometry:
+        data.update(make_synthetic_geometry(partner_df, rng))
+    return data
+
+def make_synthetic_geometry(partner_df, rng, cell_size=1000):
+    '''Purpose: square polygon per precinct on a grid (EPSG:3857, cell_size meters), and the CON districts two ways -
+    official_gdf from the squares and assigned_gdf with a few precincts moved by part of a cell, as a district assignment would differ
+    '''
+
+    import geopandas as gp
+    import shapely
+    n = len(partner_df.index)
+    width = int(np.ceil(np.sqrt(n)))
+    x = (np.arange(n) % width)*cell_size
+    y = (np.arange(n)//width)*cell_size
+    squares = shapely.box(x, y, x+cell_size, y+cell_size)
+    precinct_gdf = gp.GeoDataFrame(partner_df, geometry=squares, crs=3857)
+    shifted = rng.random(n) < .05
+    moved = shapely.box(x+shifted*cell_size*.05, y, x+cell_size+shifted*cell_size*.05, y+cell_size)
+    official_gdf = precinct_gdf[['CONG_DIST', 'geometry']].dissolve('CONG_DIST').reset_index()
+    assigned_gdf = gp.GeoDataFrame(partner_df[['CONG_DIST']], geometry=moved, crs=3857).dissolve('CONG_DIST').reset_index()
+    return {'precinct_gdf': precinct_gdf, 'official_gdf': official_gdf, 'assigned_gdf': assigned_gdf,
+            'precinct_shifted_gdf': gp.GeoDataFrame(partner_df[['UNIQUE_ID']], geometry=moved, crs=3857)}
+
+#Benchmarked functions - name: (function of the synthetic data, needs geometry, largest precinct x race cells to run it on or None)
+#The original row-by-row functions are capped so the suite finishes in minutes
+BENCHMARKS = {
+    'allocate_absentee': (lambda d: et.allocate_absentee(d['partner_df'], d['allocating_df'], d['column_list'], 'COUNTYFP'), False, 20000),
+    'allocate_absentee_vectorized': (lambda d: et.allocate_absentee_vectorized(d['partner_df'], d['allocating_df'], d['column_list'], 'COUNTYFP'), False, None),
+    'precinct_votes_check': (lambda d: et.precinct_votes_check(d['merged_df'], d['column_list'], True, 'UNIQUE_ID'), False, 200000),
+    'precinct_votes_diff': (lambda d: et.precinct_votes_diff(d['merged_df'], d['column_list'], True, 'UNIQUE_ID'), False, None),
+    'statewide_totals_check': (lambda d: et.statewide_totals_check(d['partner_df'], d['source_df'], d['column_list']), False, None),
+    'county_totals_check': (lambda d: et.county_totals_check(d['partner_df'], d['source_df'], d['column_list'], 'COUNTYFP'), False, None),
+    'reconcile_totals': (lambda d: et.reconcile_totals(d['partner_df'], d['source_df'], d['column_list'], 'UNIQUE_ID', ['COUNTYFP', 'CONG_DIST', 'SLDU_DIST', 'SLDL_DIST']), False, None),
+    'create_field_id': (lambda d: et.create_field_id(d['sos_long_df'].copy(), 'contest', 'G', '20', prop_number='party'), False, None),
+    'create_field_id_vectorized': (lambda d: et.create_field_id_vectorized(d['sos_long_df'], 'contest', 'G', '20', prop_number='party'), False, None),
+    'run_validation': (lambda d: et.run_validation(d['partner_df']), False, None),
+    'compare_geometries': (lambda d: et.compare_geometries(d['official_gdf'], d['assigned_gdf'], 'official', 'assigned', 'CONG_DIST', area_threshold=1000), True, None),
+    'compare_geometries_precincts': (lambda d: et.compare_geometries(d['precinct_gdf'][['UNIQUE_ID', 'geometry']], d['precinct_shifted_gdf'], 'official', 'assigned', 'UNIQUE_ID', area_threshold=1000), True, 20000),
+    'compare_geometries_vectorized': (lambda d: et.compare_geometries_vectorized(d['precinct_gdf'][['UNIQUE_ID', 'geometry']], d['precinct_shifted_gdf'], 'UNIQUE_ID'), True, None),
+}
+
+def run_benchmark(function, data, repeat=3, max_seconds=2):
+    '''Purpose: best wall time of up to repeat calls (without tracing, stopping once max_seconds have been spent),
+    then peak traced memory of one more call, with the printing silenced
+    '''
+
+    with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+        warnings.simplefilter('ignore')
+        timings = []
+        while len(timings) < repeat and sum(timings) < max_seconds:
+            start = time.perf_counter()
+            function(data)
+            timings.append(time.perf_counter()-start)
+        seconds = min(timings)
+        tracemalloc.start()
+        function(data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak/1e6
+
+def run_benchmarks(sizes=list(BENCHMARK_SIZES), benchmarks=list(BENCHMARKS), with_geometry=True, seed=0):
+    '''Purpose: time every benchmark on the synthetic data of every size
+    Returns DataFrame with size, function, rows, races, seconds and peak_mb (functions skipped for a size are left out)
+    '''
+
+    if with_geometry:
+        import matplotlib
+        matplotlib.use('Agg')
+    results = []
+    for size in sizes:
+        data = make_synthetic_state(with_geometry=with_geometry, seed=seed, **BENCHMARK_SIZES[size])
+        cells = BENCHMARK_SIZES[size]['n_precincts']*BENCHMARK_SIZES[size]['n_races']
+        for name in benchmarks:
+            function, needs_geometry, max_cells = BENCHMARKS[name]
+            if (needs_geometry and not with_geometry) or (max_cells is not None and cells > max_cells):
+                continue
+            seconds, peak_mb = run_benchmark(function, data)
+            results.append([size, name, BENCHMARK_SIZES[size]['n_precincts'], BENCHMARK_SIZES[size]['n_races'], seconds, peak_mb])
+            print(size, name, '{:.3f} s'.format(seconds), '{:.1f} MB'.format(peak_mb))
+    return pd.DataFrame(results, columns=['size', 'function', 'rows', 'races', 'seconds', 'peak_mb'])
+
+def compare_to_baseline(results, baseline, tolerance=1.5, min_seconds=.05):
+    '''Purpose: compare benchmark results to a baseline run
+    Arguments:
+        results, baseline: DataFrames from run_benchmarks
+        tolerance: ratio to the baseline above which the time or peak memory counts as a regression
+        min_seconds: slowdowns of fewer seconds than this are too noisy to count as a regression
+    Returns DataFrame with the baseline and current seconds/peak_mb, their ratios and a regression column
+    '''
+
+    comparison = results.merge(baseline[['size', 'function', 'seconds', 'peak_mb']], on=['size', 'function'], how='left', suffixes=('', '_baseline'))
+    comparison['seconds_ratio'] = comparison['seconds']/comparison['seconds_baseline']
+    comparison['peak_mb_ratio'] = comparison['peak_mb']/comparison['peak_mb_baseline']
+    slower = (comparison['seconds_ratio'] > tolerance) & (comparison['seconds']-comparison['seconds_baseline'] >= min_seconds)
+    comparison['regression'] = slower | (comparison['peak_mb_ratio'] > tolerance)
+    return comparison
+
+def main(argv=None):
+    '''Purpose: command line benchmark run, see the module docstring. Exit status is 1 if anything regressed
+    '''
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the erj_toolbox functions on synthetic data')
+    parser.add_argument('--sizes', nargs='+', default=list(BENCHMARK_SIZES), choices=list(BENCHMARK_SIZES))
+    parser.add_argument('--functions', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument('--no-geometry', action='store_true', help='skip the benchmarks that need geopandas')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help='write the results to the baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    et.measure_import_time()
+    results = run_benchmarks(args.sizes, args.functions, not args.no_geometry)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results.to_dict('records'), baseline_file, indent=1)
+        print('Baseline written to', args.baseline)
+        return 0
+    baseline = pd.DataFrame(json.load(open(args.baseline)))
+    comparison = compare_to_baseline(results, baseline, args.tolerance)
+    print()
+    print(comparison[['size', 'function', 'seconds', 'seconds_baseline', 'seconds_ratio', 'peak_mb', 'peak_mb_baseline', 'peak_mb_ratio', 'regression']].to_string(index=False))
+    if comparison['regression'].any():
+        print('Regressions:', list(comparison.loc[comparison['regression'], 'size']+' '+comparison.loc[comparison['regression'], 'function']))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
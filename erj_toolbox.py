@@ -1,11 +1,357 @@
 '''Following Docstring Convention: https://www.python.org/dev/peps/pep-0257/'''
 
 import pandas as pd
+import numpy as np
 import os
-#THESE SETTINGS ESSENTIAL TO HAVE THE FIELDS TABLE SHOW UP CORRECTLY in the readme
-pd.set_option('display.max_rows', None)
-pd.set_option('display.max_columns', None)
-pd.set_option('display.width', None)
+import re
+import sys
+import json
+import time
+from collections import Counter
+from functools import lru_cache, wraps
+#geopandas, shapely, matplotlib, pyogrio and pyarrow are imported inside the functions that use them,
+#so importing the toolbox (ex: in batch worker processes) only loads pandas and numpy
+
+def set_display_options():
+    
+    '''Purpose: show every row and column when printing DataFrames.
+    THESE SETTINGS ESSENTIAL TO HAVE THE FIELDS TABLE SHOW UP CORRECTLY in the readme - call before printing it
+    (no longer set on import, so importing the toolbox doesn't change pandas settings)
+    '''
+    
+    pd.set_option('display.max_rows', None)
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.width', None)
+
+
+#Opt-in instrumentation of the toolbox functions, see enable_instrumentation
+#sinks: callables given one record per call, stack: the records of the instrumented calls in progress (innermost last)
+_INSTRUMENTATION = {"sinks": [], "trace_memory": False, "started_tracemalloc": False, "stack": []}
+
+def enable_instrumentation(*sinks, trace_memory=False):
+    '''Purpose: start recording every call to the instrumented toolbox functions (the checks, allocation, field naming,
+    geometry comparison, splitting, file and validation functions). Off by default, when off the calls are not recorded.
+    Arguments:
+        sinks: callables given one record dictionary per call, ex: records.append to keep them in memory,
+            or json_lines_sink("erj_profile.jsonl") to append them to a file
+        trace_memory: also record each call's peak memory with tracemalloc (makes the calls several times slower)
+    Each record has:
+        function, depth (number of instrumented calls it was made from), start (time.time()), seconds,
+        rows and columns (summed over the DataFrame arguments), peak_mb (memory peak above the start of the call, None if not traced),
+        error (the exception's name if the call raised one, else None), fallbacks (dictionary of fallback path: count, see count_fallback)
+        and cache_hits (number of results read from the geometry cache, see count_cache_hit)
+    Only calls in this process are recorded, not calls in the worker processes of the batch/parallel functions
+    '''
+
+    _INSTRUMENTATION["sinks"] = list(sinks)
+    _INSTRUMENTATION["trace_memory"] = trace_memory
+    if trace_memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _INSTRUMENTATION["started_tracemalloc"] = True
+
+def disable_instrumentation():
+    '''Purpose: stop recording calls, and stop tracemalloc if enable_instrumentation started it
+    '''
+
+    _INSTRUMENTATION["sinks"] = []
+    _INSTRUMENTATION["trace_memory"] = False
+    if _INSTRUMENTATION["started_tracemalloc"]:
+        import tracemalloc
+        tracemalloc.stop()
+        _INSTRUMENTATION["started_tracemalloc"] = False
+
+def json_lines_sink(path):
+    '''Purpose: sink for enable_instrumentation that appends each record to path as one line of JSON, read back with read_instrumentation
+    '''
+
+    def write_record(record):
+        with open(path, "a") as sink_file:
+            sink_file.write(json.dumps(record, default=str)+"\n")
+    return write_record
+
+def read_instrumentation(path):
+    '''Purpose: the records written by json_lines_sink, as a list of dictionaries
+    '''
+
+    with open(path) as sink_file:
+        return [json.loads(line) for line in sink_file if line.strip()]
+
+def count_fallback(name, count=1):
+    '''Purpose: count a fallback path (ex: "special_allocation") in the record of the innermost instrumented call in progress,
+    does nothing when instrumentation is off
+    '''
+
+    if _INSTRUMENTATION["stack"] and count:
+        fallbacks = _INSTRUMENTATION["stack"][-1]["fallbacks"]
+        fallbacks[name] = fallbacks.get(name, 0)+int(count)
+
+def count_cache_hit(count=1):
+    '''Purpose: count results read from the geometry cache in the record of the innermost instrumented call in progress,
+    does nothing when instrumentation is off
+    '''
+
+    if _INSTRUMENTATION["stack"] and count:
+        _INSTRUMENTATION["stack"][-1]["cache_hits"] += int(count)
+
+def instrumented(function):
+    '''Purpose: decorator recording the calls to a toolbox function while instrumentation is enabled, see enable_instrumentation
+    '''
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _INSTRUMENTATION["sinks"]:
+            return function(*args, **kwargs)
+        frames = [arg for arg in list(args)+list(kwargs.values()) if isinstance(arg, pd.DataFrame)]
+        stack = _INSTRUMENTATION["stack"]
+        record = {"function": function.__name__, "depth": len(stack), "start": time.time(), "seconds": None,
+                  "rows": sum(len(frame.index) for frame in frames), "columns": sum(len(frame.columns) for frame in frames),
+                  "peak_mb": None, "error": None, "fallbacks": {}, "cache_hits": 0}
+        trace_memory = _INSTRUMENTATION["trace_memory"]
+        if trace_memory:
+            import tracemalloc
+            start_memory, outer_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            record["_peak"] = 0
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["seconds"] = time.perf_counter()-start
+            stack.pop()
+            if trace_memory:
+                #reset_peak is shared by nested calls, so each call also keeps the highest peak of the calls inside it
+                peak = max(tracemalloc.get_traced_memory()[1], record.pop("_peak"))
+                record["peak_mb"] = (peak-start_memory)/1e6
+                if stack:
+                    stack[-1]["_peak"] = max(stack[-1].get("_peak", 0), peak, outer_peak)
+            for sink in _INSTRUMENTATION["sinks"]:
+                sink(record)
+    return wrapper
+
+def summarize_instrumentation(records):
+    '''Purpose: summarize the recorded calls of a run, one row per function
+    Arguments:
+        records: list of records, ex: the list given to enable_instrumentation, or read_instrumentation(path)
+    Returns DataFrame indexed by function with calls, errors, total_seconds, mean_seconds, max_seconds, rows, max_columns,
+    max_peak_mb, cache_hits and one fallback_<name> count column per fallback path, slowest total first
+    '''
+
+    if len(records) == 0:
+        return pd.DataFrame(columns=["calls", "errors", "total_seconds", "mean_seconds", "max_seconds", "rows", "max_columns", "max_peak_mb", "cache_hits"])
+    calls = pd.DataFrame(records)
+    calls["peak_mb"] = pd.to_numeric(calls["peak_mb"])
+    calls["failed"] = calls["error"].notna()
+    #Records written before cache_hits was recorded don't have it
+    calls["cache_hits"] = calls["cache_hits"].fillna(0).astype(int) if "cache_hits" in calls.columns else 0
+    summary = calls.groupby("function").agg(calls=("seconds", "size"), errors=("failed", "sum"), total_seconds=("seconds", "sum"),
+                                            mean_seconds=("seconds", "mean"), max_seconds=("seconds", "max"), rows=("rows", "sum"),
+                                            max_columns=("columns", "max"), max_peak_mb=("peak_mb", "max"),
+                                            cache_hits=("cache_hits", "sum"))
+    fallbacks = pd.DataFrame(list(calls["fallbacks"]), index=calls["function"]).fillna(0)
+    if len(fallbacks.columns):
+        fallbacks = fallbacks.groupby(level=0).sum().astype(int).add_prefix("fallback_")
+        summary = summary.join(fallbacks)
+    return summary.sort_values("total_seconds", ascending=False)
+
+def print_instrumentation_summary(summary):
+    '''Purpose: print the summarize_instrumentation table, with the functions that took fallback paths listed below it
+    '''
+
+    print("Instrumented calls, slowest total first:")
+    print(summary.to_string())
+    for column in [column for column in summary.columns if column.startswith("fallback_")]:
+        used = summary.loc[summary[column] > 0, column]
+        for function, count in used.items():
+            print(function+" took the "+column[len("fallback_"):]+" fallback "+str(count)+" time(s)")
+
+
+#Compact dtypes, see compact_dtypes
+#Unsigned integer dtypes tried in order for vote counts
+VOTE_DTYPES = [np.uint8, np.uint16, np.uint32, np.uint64]
+
+def smallest_vote_dtype(values):
+    '''Purpose: smallest of VOTE_DTYPES that holds every value in an array of vote counts
+    Returns None if there are missing, negative or fractional values, or values that aren't numbers
+    '''
+
+    values = np.asarray(values)
+    if values.dtype.kind not in 'uif':
+        return None
+    if values.size == 0:
+        return np.dtype(VOTE_DTYPES[0])
+    if values.dtype.kind == 'f' and not (np.isfinite(values).all() and (values == np.floor(values)).all()):
+        return None
+    if values.min() < 0:
+        return None
+    largest = values.max()
+    for dtype in VOTE_DTYPES:
+        if largest <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return None
+
+@instrumented
+def compact_dtypes(df, vote_cols=None, key_cols=None, max_category_ratio=.5):
+    '''Purpose: shrink the memory of a results DataFrame - vote counts to the smallest unsigned integer dtype
+    that holds them and repeated strings (precinct keys, county codes, contests, parties...) to categoricals
+    Arguments:
+        df: results DataFrame, long-format or wide (not changed)
+        vote_cols: vote count columns, None for every numeric column with only whole, non-negative values
+        key_cols: string columns to make categorical, None for every string column with
+            no more than max_category_ratio distinct values per row
+    Returns the compacted DataFrame and a DataFrame of the changed columns with their old and new dtype and MB
+    The toolbox functions keep these dtypes: keys are grouped with observed=True, vote totals are compared as signed
+    integers (see signed_vote_totals) and allocate_absentee_vectorized only widens a vote column if the allocated votes don't fit
+    Sparse vote columns (see to_sparse_votes) stay sparse, and create_erj_shp and write_erj_files turn the categoricals back (see densify_votes)
+    '''
+
+    if vote_cols is None:
+        vote_cols = [col for col in df.columns if df[col].dtype.kind in 'uif']
+    if key_cols is None:
+        key_cols = [col for col in df.columns if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) == 'string'
+                    and df[col].nunique() <= max_category_ratio*len(df.index)]
+    new_dtypes = {}
+    for col in vote_cols:
+        if is_sparse_vote_column(df[col]):
+            #Sparse columns (see to_sparse_votes) stay sparse, only their stored values are compacted
+            dtype = smallest_vote_dtype(df[col].array.sp_values)
+            dtype = pd.SparseDtype(dtype, 0) if dtype is not None and df[col].dtype.fill_value == 0 else None
+        else:
+            dtype = smallest_vote_dtype(df[col].to_numpy())
+        if dtype is not None and dtype != df[col].dtype:
+            new_dtypes[col] = dtype
+    for col in key_cols:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            new_dtypes[col] = 'category'
+    old_dtypes = [str(df[col].dtype) for col in new_dtypes]
+    before = df[list(new_dtypes)].memory_usage(index=False, deep=True)
+    df = df.astype(new_dtypes)
+    after = df[list(new_dtypes)].memory_usage(index=False, deep=True)
+    report = pd.DataFrame({"column": list(new_dtypes),
+                           "old_dtype": old_dtypes,
+                           "new_dtype": [str(df[col].dtype) for col in new_dtypes],
+                           "old_mb": before.to_numpy()/1e6,
+                           "new_mb": after.to_numpy()/1e6})
+    print("Compacted "+str(len(new_dtypes))+" columns: "+"{:.1f}".format(before.sum()/1e6)+" MB -> "+"{:.1f}".format(after.sum()/1e6)+" MB")
+    return df, report
+
+def signed_vote_totals(totals):
+    '''Purpose: cast the unsigned integer columns of a DataFrame of vote totals (ex: grouped sums of compact_dtypes columns)
+    to int64, so the difference of two sets of totals can go negative instead of wrapping around
+    '''
+
+    unsigned = {col: 'int64' for col, dtype in totals.dtypes.items() if dtype.kind == 'u'}
+    return totals.astype(unsigned) if unsigned else totals
+
+#Sparse vote columns, see to_sparse_votes
+def is_sparse_vote_column(series):
+    return isinstance(series.dtype, pd.SparseDtype)
+
+@instrumented
+def to_sparse_votes(df, vote_cols=None, max_density=.1):
+    '''Purpose: store the mostly-zero vote columns of a wide results DataFrame as pandas sparse columns, which only keep
+    the nonzero votes. After pivoting, every precinct only has votes in one CON, SU and SL district, so the hundreds of
+    district columns (ex: GCON04RSMI, GSL112DJON) are almost all zeros.
+    Arguments:
+        df: wide results DataFrame (not changed)
+        vote_cols: vote count columns, None for every numeric column
+        max_density: only columns with at most this share of nonzero rows are made sparse
+    Returns the DataFrame with the sparse columns. The checks, allocate_absentee_vectorized, find_split_precincts and
+    district_assignment_errors work on them directly, and create_erj_shp and write_erj_files densify them (see densify_votes)
+    '''
+
+    if vote_cols is None:
+        vote_cols = [col for col in df.columns if df[col].dtype.kind in 'uif' and not is_sparse_vote_column(df[col])]
+    new_dtypes = {}
+    for col in vote_cols:
+        if is_sparse_vote_column(df[col]):
+            continue
+        values = df[col].to_numpy()
+        if np.count_nonzero(values) <= max_density*len(values):
+            new_dtypes[col] = pd.SparseDtype(values.dtype, 0)
+    before = df[list(new_dtypes)].memory_usage(index=False).sum()
+    df = df.astype(new_dtypes)
+    after = df[list(new_dtypes)].memory_usage(index=False).sum()
+    print("Made "+str(len(new_dtypes))+" columns sparse: "+"{:.1f}".format(before/1e6)+" MB -> "+"{:.1f}".format(after/1e6)+" MB")
+    return df
+
+def densify_votes(df):
+    '''Purpose: turn the sparse vote columns (see to_sparse_votes) and the categorical columns (see compact_dtypes)
+    of a DataFrame back into regular columns, which is what the file writers can handle
+    Returns the DataFrame, or df itself if it has neither
+    '''
+
+    sparse_cols = [col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.SparseDtype)]
+    category_cols = [col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    if not (sparse_cols or category_cols):
+        return df
+    df = df.copy(deep=False)
+    for col in sparse_cols:
+        df[col] = df[col].sparse.to_dense()
+    for col in category_cols:
+        df[col] = df[col].astype(df[col].dtype.categories.dtype)
+    return df
+
+def nonzero_votes(df, cols):
+    '''Purpose: rows, column positions (into cols) and values of the nonzero (or NaN) votes of df[cols], in row order like np.nonzero.
+    Sparse columns are read from their stored values, so the (precinct x column) matrix is never densified.
+    '''
+
+    if not any(is_sparse_vote_column(df[col]) for col in cols):
+        votes = df[cols].to_numpy()
+        rows, positions = np.nonzero(votes != 0)
+        return rows, positions, votes[rows, positions]
+    rows, positions, values = [], [], []
+    for j, col in enumerate(cols):
+        if is_sparse_vote_column(df[col]):
+            array = df[col].array
+            col_rows, col_values = array.sp_index.indices, array.sp_values
+            if array.fill_value != 0:
+                col_rows, col_values = np.arange(len(array)), array.to_dense()
+        else:
+            col_rows, col_values = np.arange(len(df.index)), df[col].to_numpy()
+        keep = col_values != 0
+        rows.append(col_rows[keep])
+        positions.append(np.full(keep.sum(), j))
+        values.append(col_values[keep])
+    rows, positions = np.concatenate(rows), np.concatenate(positions)
+    order = np.lexsort((positions, rows))
+    return rows[order], positions[order], np.concatenate(values)[order]
+
+def grouped_vote_totals(df, column_list, by, dropna=True):
+    '''Purpose: df.groupby(by, observed=True, dropna=dropna)[column_list].sum() for DataFrames with sparse vote columns.
+    Pandas densifies a sparse column for every group it sums, so the sparse columns are summed from their
+    nonzero votes with np.bincount instead. The totals are regular (dense) columns, in groupby order.
+    '''
+
+    grouped = df.groupby(by, observed=True, dropna=dropna)
+    sparse_cols = [col for col in column_list if is_sparse_vote_column(df[col])]
+    if not sparse_cols:
+        return grouped[column_list].sum()
+    dense_cols = [col for col in column_list if col not in sparse_cols]
+    totals = grouped[dense_cols].sum() if dense_cols else pd.DataFrame(index=grouped.size().index)
+    codes = grouped.ngroup().to_numpy()
+    n_groups = len(totals.index)
+    sparse_totals = {}
+    for col in sparse_cols:
+        array = df[col].array
+        rows, values = array.sp_index.indices, np.nan_to_num(array.sp_values)
+        if array.fill_value != 0:
+            rows, values = np.arange(len(array)), np.nan_to_num(array.to_dense())
+        group = codes[rows]
+        keep = ~np.isnan(group) if group.dtype.kind == 'f' else slice(None)
+        sums = np.bincount(group[keep].astype(np.intp), weights=values[keep], minlength=n_groups)
+        subtype = array.dtype.subtype
+        if subtype.kind in 'iub':
+            sums = np.round(sums).astype(np.uint64 if subtype.kind == 'u' else np.int64)
+        sparse_totals[col] = sums
+    totals = pd.concat([totals, pd.DataFrame(sparse_totals, index=totals.index)], axis=1)
+    return totals[column_list]
 
      
 def column_prefix_col(df, contest_col, election_type, election_year, cong_str='U.S. Representative in Congress', uss_str='U.S. Senator', pre_str='President', 
@@ -40,6 +386,7 @@ def column_prefix_col(df, contest_col, election_type, election_year, cong_str='U
 
     return df['contest_formatted']
 
+@instrumented
 def create_field_id(df, contest_col, election_type, election_year, cong_str='U.S. Representative in Congress', uss_str='U.S. Senator', pre_str='President', 
                       sll_str='State Representative', slu_str='State Senator', pro_str='Proposition', coc_str='Corporation', ssc_str='Supreme Court', party_1char='party', party_3char='party',choice_3char='choice', prop_number='contest', prop_choice='choice', 
                     sldl_dist='sldl_dist', sldl_zfill=2, sldu_dist='sldu_dist', sldu_zfill=2, con_dist='usrep_dist', ssc_yes_or_no='choice'):
@@ -77,6 +424,296 @@ def create_field_id(df, contest_col, election_type, election_year, cong_str='U.S
     return df['field_id']
 
 
+#Offices recognized in SOS contest names - office code: (string found in the contest name, whether the prefix has the year, field name format)
+#Field name formats: 'party' = party + choice, 'district' = district + party + choice,
+#'proposition' = proposition number + choice, 'retention' = yes/no + choice
+#When a contest name has more than one of the strings, the office listed last wins (same as column_prefix_col)
+CONTEST_OFFICES = {'CON':('U.S. Representative in Congress', False, 'district'),
+                   'USS':('U.S. Senator', True, 'party'),
+                   'PRE':('President', True, 'party'),
+                   'SL':('State Representative', False, 'district'),
+                   'SU':('State Senator', False, 'district'),
+                   'PRO':('Proposition', True, 'proposition'),
+                   'COC':('Corporation', True, 'party'),
+                   'SSC':('Supreme Court', True, 'retention')}
+
+def classify_contests(contests, offices=CONTEST_OFFICES):
+
+    '''Purpose: find the office code for every row of a contest column,
+    searching each unique contest name only once with compiled patterns
+    Arguments:
+        contests: Series of SOS contest names
+        offices: office table, see CONTEST_OFFICES
+    Returns a categorical Series of office codes, NaN where the contest matches no office
+    '''
+
+    contests = contests.astype('category')
+    office_codes = list(offices)
+    patterns = [(office_codes.index(code), re.compile(re.escape(string))) for code, (string, with_year, field_format) in reversed(list(offices.items()))]
+    #One office per unique contest, -1 for no match (the extra -1 at the end is for missing contest names)
+    office_of_contest = np.full(len(contests.cat.categories)+1, -1)
+    for i, contest in enumerate(contests.cat.categories):
+        for code_index, pattern in patterns:
+            if pattern.search(str(contest)):
+                office_of_contest[i] = code_index
+                break
+    return pd.Series(pd.Categorical.from_codes(office_of_contest[contests.cat.codes.to_numpy()], categories=office_codes), index=contests.index)
+
+@instrumented
+def create_field_id_vectorized(df, contest_col, election_type, election_year, offices=CONTEST_OFFICES, party_1char='party', choice_3char='choice',
+                               prop_number='contest', prop_choice='choice', ssc_yes_or_no='choice', write_in_col='is_write_in',
+                               district_cols={'SL':('sldl_dist', 2), 'SU':('sldu_dist', 2), 'CON':('usrep_dist', 2)}):
+
+    '''Purpose: same RDH field names as create_field_id, but each contest name is classified once (classify_contests)
+    and the names are built with vectorized string concatenation, one office at a time. Does not add columns to df.
+    Arguments:
+        offices: office table, see CONTEST_OFFICES - add or change offices here rather than with extra arguments
+        district_cols: office code: (district column, zfill) for every office with the 'district' format
+        write_in_col: column that is 'true' for write-in candidates, named <prefix>(<district>)OWRI
+        See create_field_id for the other arguments
+    Returns a Series of field names, NaN for contests that match no office (unless they are write-ins)
+    Works on the categorical columns from compact_dtypes too
+    '''
+
+    office = classify_contests(df[contest_col], offices)
+    prefix = pd.Series(office.cat.rename_categories([election_type+(election_year if with_year else '')+code
+                                                     for code, (string, with_year, field_format) in offices.items()]).astype(object).fillna('0'), index=df.index)
+    write_in = (df[write_in_col]=='true').to_numpy()
+    field_id = pd.Series(np.where(write_in, prefix+'OWRI', np.nan), index=df.index, dtype=object)
+    for code, (string, with_year, field_format) in offices.items():
+        in_office = (office==code).to_numpy()
+        if not in_office.any():
+            continue
+        rows = in_office & ~write_in
+        if field_format == 'district':
+            dist_col, dist_zfill = district_cols[code]
+            district = prefix[in_office] + df.loc[in_office, dist_col].str.zfill(dist_zfill)
+            field_id[in_office & write_in] = district[write_in[in_office]] + 'OWRI'
+            field_id[rows] = district[~write_in[in_office]] + df.loc[rows, party_1char].astype(object) + df.loc[rows, choice_3char].astype(object)
+        elif field_format == 'party':
+            field_id[rows] = prefix[rows] + df.loc[rows, party_1char].astype(object) + df.loc[rows, choice_3char].astype(object)
+        elif field_format == 'proposition':
+            field_id[rows] = prefix[rows] + df.loc[rows, prop_number].astype(object) + df.loc[rows, prop_choice].astype(object)
+        elif field_format == 'retention':
+            field_id[rows] = prefix[rows] + df.loc[rows, ssc_yes_or_no].astype(object) + df.loc[rows, choice_3char].astype(object)
+        else:
+            raise ValueError('Unknown field name format: '+field_format)
+    return field_id
+
+def widen_field_totals(totals, sparse=False, max_density=.1):
+
+    '''Purpose: one row per precinct and one column per field name (sorted) from a Series of vote totals indexed by
+    the precinct column(s) and then the field name (used by pivot_field_ids and stream_field_id_pivot)
+    With sparse=True the field columns with at most max_density nonzero rows (ex: the district columns) are built as
+    sparse columns (see to_sparse_votes) straight from the totals, without the dense (precinct x field) matrix
+    '''
+
+    if not sparse:
+        wide = totals.unstack(-1, fill_value=0).astype('int64').sort_index(axis=1).sort_index()
+        wide.columns.name = None
+        return wide.reset_index()
+    precincts = totals.index.droplevel(-1).unique().sort_values()
+    fields = totals.index.get_level_values(-1).unique().sort_values()
+    totals = totals[totals != 0]
+    rows = precincts.get_indexer(totals.index.droplevel(-1))
+    cols = fields.get_indexer(totals.index.get_level_values(-1))
+    values = totals.to_numpy().astype('int64')
+    order = np.lexsort((rows, cols))
+    col_starts = np.searchsorted(cols[order], np.arange(len(fields)+1))
+    wide = {}
+    for j, field in enumerate(fields):
+        col_rows = rows[order[col_starts[j]:col_starts[j+1]]]
+        column = np.zeros(len(precincts), dtype='int64')
+        column[col_rows] = values[order[col_starts[j]:col_starts[j+1]]]
+        wide[field] = pd.arrays.SparseArray(column, fill_value=0) if len(col_rows) <= max_density*len(precincts) else column
+    return pd.DataFrame(wide, index=precincts).reset_index()
+
+@instrumented
+def pivot_field_ids(df, precinct_cols, votes_col, field_col='field_id', sparse=False):
+
+    '''Purpose: pivot long-format results (one row per precinct, contest and candidate) to one row per precinct
+    and one column per field name, summing the votes of repeated rows
+    Arguments:
+        df: long-format results with a field name column, ex: df['field_id'] = create_field_id_vectorized(df, ...)
+        precinct_cols: list of columns identifying a precinct, ex: ['county', 'precinct']
+        votes_col: vote count column
+        field_col: field name column, rows where it is NaN are dropped
+        sparse: build the field columns as sparse columns (see to_sparse_votes), for files with many district columns
+    Returns DataFrame with the precinct_cols and then the field names in sorted order, integer votes (0 where a precinct has none)
+    '''
+
+    votes = pd.to_numeric(df[votes_col]).fillna(0)
+    totals = votes.groupby([df[col] for col in precinct_cols]+[df[field_col]],observed=True).sum()
+    return widen_field_totals(totals, sparse)
+
+@instrumented
+def stream_field_id_pivot(source, precinct_cols, votes_col, contest_col, election_type, election_year, chunksize=500000,
+                          read_csv_kwargs={}, sparse=False, **field_id_kwargs):
+
+    '''Purpose: streaming version of create_field_id_vectorized followed by pivot_field_ids, for SOS files too large to load at once.
+    The file is read chunksize rows at a time, each chunk gets its field names and is summed by precinct and field name,
+    and only those sums are kept between chunks - memory is bounded by one chunk plus the nonzero precinct/field pairs,
+    never the whole long-format file.
+    Arguments:
+        source: path of a long-format csv, or an iterable of long-format DataFrames (ex: pd.read_excel sheets, one per county)
+        precinct_cols, votes_col: see pivot_field_ids
+        contest_col, election_type, election_year, field_id_kwargs: see create_field_id_vectorized
+        chunksize: rows per chunk read from the csv
+        read_csv_kwargs: extra pd.read_csv arguments, ex: {'usecols': [...], 'sep': '\\t'} - every column is read as a string
+            so district numbers keep their leading zeros, and votes_col is converted to numbers
+        sparse: see pivot_field_ids
+    Returns the same DataFrame as pivot_field_ids on the whole file
+    '''
+
+    if isinstance(source, (str, os.PathLike)):
+        source = pd.read_csv(source, chunksize=chunksize, dtype=str, keep_default_na=False, na_values=[''], **read_csv_kwargs)
+    totals = None
+    #Chunk sums waiting to be added to totals, combined once they are at least as long as totals
+    #so the running totals aren't regrouped on every chunk
+    pending = []
+    pending_rows = 0
+    rows = 0
+    for chunk in source:
+        rows += len(chunk.index)
+        field_id = create_field_id_vectorized(chunk, contest_col, election_type, election_year, **field_id_kwargs)
+        votes = pd.to_numeric(chunk[votes_col]).fillna(0).astype('int64')
+        chunk_totals = votes.groupby([chunk[col] for col in precinct_cols]+[field_id.rename('_field_id')],observed=True).sum()
+        if totals is None:
+            totals = chunk_totals
+            continue
+        pending.append(chunk_totals)
+        pending_rows += len(chunk_totals.index)
+        if pending_rows >= len(totals.index):
+            totals = pd.concat([totals]+pending).groupby(level=list(range(len(precinct_cols)+1))).sum()
+            pending = []
+            pending_rows = 0
+    if totals is None:
+        raise ValueError('No rows read from source')
+    if pending:
+        totals = pd.concat([totals]+pending).groupby(level=list(range(len(precinct_cols)+1))).sum()
+    print('Pivoted '+str(rows)+' rows into '+str(len(totals.index))+' precinct/field totals')
+    return widen_field_totals(totals, sparse)
+
+#File extensions read by load_county_files
+COUNTY_FILE_EXTENSIONS = ['.csv', '.txt', '.xlsx', '.xls']
+
+def read_county_file(file_path, schema, rename={}, read_kwargs={}):
+    '''Purpose: read one county results file for load_county_files (module-level so it can run in a worker process)
+    Every column is read as a string (district numbers keep their leading zeros), renamed, and converted to the schema:
+    'votes' columns to numbers (blank is 0, thousands separators are dropped) in the smallest unsigned dtype that holds them
+    Returns dictionary with the file, rows, seconds, error (the exception text if the file could not be read or doesn't
+    have the schema's columns) and df (the converted DataFrame, None on error)
+    '''
+
+    start = time.perf_counter()
+    result = {"file": file_path, "rows": None, "seconds": None, "error": None, "df": None}
+    try:
+        schema_name = lambda col: rename.get(str(col).strip(), str(col).strip())
+        if os.path.splitext(file_path)[1].lower() in ['.xlsx', '.xls']:
+            df = pd.read_excel(file_path, dtype=str, usecols=lambda col: schema_name(col) in schema, **read_kwargs)
+        else:
+            #Only the schema's columns are read, and the vote columns are left to the csv parser's number parsing
+            keep = [col for col in pd.read_csv(file_path, nrows=0, **read_kwargs).columns if schema_name(col) in schema]
+            df = pd.read_csv(file_path, usecols=keep, dtype={col: str for col in keep if schema[schema_name(col)] != 'votes'},
+                             keep_default_na=False, na_values=[''], **read_kwargs)
+        df = df.rename(columns=schema_name)
+        missing = [col for col in schema if col not in df.columns]
+        if missing:
+            raise ValueError("Missing columns: "+str(missing))
+        columns = {}
+        for col, dtype in schema.items():
+            if dtype == 'votes':
+                votes = df[col]
+                if votes.dtype == object:
+                    votes = pd.to_numeric(votes.str.replace(',', '', regex=False))
+                votes = votes.fillna(0).to_numpy()
+                vote_dtype = smallest_vote_dtype(votes)
+                columns[col] = votes.astype(vote_dtype) if vote_dtype is not None else votes
+            else:
+                columns[col] = df[col].astype(dtype)
+        result["df"] = pd.DataFrame(columns)
+        result["rows"] = len(df.index)
+    except Exception as e:
+        result["error"] = repr(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def concat_compact_frames(frames):
+    '''Purpose: concatenate DataFrames with the same columns one column at a time, without an intermediate concatenated frame.
+    Categorical columns are combined with union_categoricals (so they stay categorical even when each frame has its own
+    categories) and number columns are concatenated in the smallest dtype that holds all of them (unsigned vote counts stay unsigned)
+    '''
+
+    columns = {}
+    for col in frames[0].columns:
+        parts = [frame[col] for frame in frames]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[col] = pd.api.types.union_categoricals(parts)
+        else:
+            dtype = np.result_type(*[part.dtype for part in parts])
+            if dtype.kind == 'f' and all(part.dtype.kind in 'iu' for part in parts):
+                dtype = np.dtype('int64')
+            columns[col] = np.concatenate([part.to_numpy() for part in parts]).astype(dtype, copy=False)
+    return pd.DataFrame(columns)
+
+@instrumented
+def load_county_files(source, schema, rename={}, county_col='county_file', max_workers=8, processes=False, read_kwargs={}):
+    '''Purpose: read a directory of per-county SOS results files (csv or xlsx) across a bounded pool of workers,
+    and concatenate them into one statewide DataFrame, ex: before create_field_id_vectorized and the totals checks
+    Arguments:
+        source: directory of county files (every COUNTY_FILE_EXTENSIONS file in it, in name order) or a list of file paths
+        schema: column: dtype of the columns to keep, in order, shared by every file, ex: {'precinct': str, 'contest': 'category',
+            'party': 'category', 'candidate': 'category', 'votes': 'votes'}; 'votes' columns are compacted like compact_dtypes
+        rename: header: schema column, for counties whose headers differ, ex: {'Precinct Name': 'precinct', 'Total Votes': 'votes'}
+        county_col: name of a categorical column with the file name (without extension) of every row, None for no such column
+        max_workers: number of files read at once
+        processes: read in worker processes instead of threads (faster for xlsx, which is parsed in Python; the
+            DataFrames are copied back to this process)
+        read_kwargs: extra pd.read_csv / pd.read_excel arguments, ex: {'sep': '\t'} or {'sheet_name': 0}
+    Returns the DataFrame (files that could not be read are left out) and a DataFrame report of every file with its
+    rows, seconds, rows_per_second, MB on disk and error, to spot a malformed or slow county file
+    '''
+
+    if isinstance(source, (str, os.PathLike)):
+        files = [os.path.join(source, f) for f in sorted(os.listdir(source)) if os.path.splitext(f)[1].lower() in COUNTY_FILE_EXTENSIONS]
+    else:
+        files = list(source)
+    if not files:
+        raise ValueError('No county files found in '+str(source))
+    schema = dict(schema)
+    if max_workers <= 1 or len(files) <= 1:
+        results = [read_county_file(file_path, schema, rename, read_kwargs) for file_path in files]
+    else:
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        executor_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor_type(max_workers=min(max_workers, len(files))) as executor:
+            results = list(executor.map(read_county_file, files, [schema]*len(files), [rename]*len(files), [read_kwargs]*len(files)))
+
+    report = pd.DataFrame({"file": [os.path.basename(result["file"]) for result in results],
+                           "rows": [result["rows"] for result in results],
+                           "seconds": [result["seconds"] for result in results],
+                           "MB": [os.path.getsize(result["file"])/1e6 if os.path.exists(result["file"]) else None for result in results],
+                           "error": [result["error"] for result in results]})
+    report["rows_per_second"] = report["rows"]/report["seconds"]
+    read = [result for result in results if result["error"] is None]
+    for result in results:
+        if result["error"] is not None:
+            print("Could not read "+result["file"]+": "+result["error"])
+    if not read:
+        raise ValueError('None of the '+str(len(files))+' county files could be read')
+
+    df = concat_compact_frames([result["df"] for result in read])
+    if county_col is not None:
+        counties = [os.path.splitext(os.path.basename(result["file"]))[0] for result in read]
+        codes = np.repeat(np.arange(len(read)), [result["rows"] for result in read])
+        df.insert(0, county_col, pd.Categorical.from_codes(codes, categories=pd.Index(counties).unique()) if len(set(counties)) == len(counties)
+                  else pd.Categorical(np.array(counties, dtype=object)[codes]))
+    slowest = report.loc[report["seconds"].idxmax()]
+    print("Loaded "+str(len(df.index))+" rows from "+str(len(read))+" of "+str(len(files))+" county files in "
+          +"{:.1f}".format(report["seconds"].sum())+" s of reading, slowest: "+slowest["file"]+" ("+"{:.2f}".format(slowest["seconds"])+" s)")
+    return df, report
+
+
 
 def mk_precinct_district_id(df, precinct_key_col, sldl_dist_col, sldu_dist_col, usrep_dist_col):
     
@@ -92,22 +729,23 @@ def mk_precinct_district_id(df, precinct_key_col, sldl_dist_col, sldu_dist_col,
     '''
     
     #Create column with precinct-district id for sldl, sldu and usrep
-    df['prec_sldl_id_og'] = df['precinct_key'][df[sldl_dist_col]!='NA'] + '-'+df[sldl_dist_col][df[sldl_dist_col]!='NA']
-    df['prec_sldu_id_og'] = df['precinct_key'][df[sldu_dist_col]!='NA'] + '-'+df[sldu_dist_col][df[sldu_dist_col]!='NA']
-    df['prec_usrep_id_og'] = df['precinct_key'][df[usrep_dist_col]!='NA'] + '-'+df[usrep_dist_col][df[usrep_dist_col]!='NA']
+    df['prec_sldl_id_og'] = df[precinct_key_col][df[sldl_dist_col]!='NA'] + '-'+df[sldl_dist_col][df[sldl_dist_col]!='NA']
+    df['prec_sldu_id_og'] = df[precinct_key_col][df[sldu_dist_col]!='NA'] + '-'+df[sldu_dist_col][df[sldu_dist_col]!='NA']
+    df['prec_usrep_id_og'] = df[precinct_key_col][df[usrep_dist_col]!='NA'] + '-'+df[usrep_dist_col][df[usrep_dist_col]!='NA']
     #Dictionary precinct_key: precinct_key with district
-    sldl_prec_key_dict = {value : key for (key, value) in pd.Series(df['precinct_key'].values, index = df['prec_sldl_id_og']).to_dict().items()}
-    sldu_prec_key_dict = {value : key for (key, value) in pd.Series(df['precinct_key'].values, index = df['prec_sldu_id_og']).to_dict().items()}
-    usrep_prec_key_dict = {value : key for (key, value) in pd.Series(df['precinct_key'].values, index = df['prec_usrep_id_og']).to_dict().items()}
+    sldl_prec_key_dict = {value : key for (key, value) in pd.Series(df[precinct_key_col].values, index = df['prec_sldl_id_og']).to_dict().items()}
+    sldu_prec_key_dict = {value : key for (key, value) in pd.Series(df[precinct_key_col].values, index = df['prec_sldu_id_og']).to_dict().items()}
+    usrep_prec_key_dict = {value : key for (key, value) in pd.Series(df[precinct_key_col].values, index = df['prec_usrep_id_og']).to_dict().items()}
     #Create column for entire df with given district numbers
-    df['prec_sldl_id_toall'] = df['precinct_key'].map(sldl_prec_key_dict)
-    df['prec_sldu_id_toall'] = df['precinct_key'].map(sldu_prec_key_dict)
-    df['prec_usrep_id_toall'] = df['precinct_key'].map(usrep_prec_key_dict)
+    df['prec_sldl_id_toall'] = df[precinct_key_col].map(sldl_prec_key_dict)
+    df['prec_sldu_id_toall'] = df[precinct_key_col].map(sldu_prec_key_dict)
+    df['prec_usrep_id_toall'] = df[precinct_key_col].map(usrep_prec_key_dict)
     #Create column with single identifier with district numbers for every office
     df['prec_id_sldl_sldu_usrep'] = '['+df['prec_sldl_id_toall']+']['+df['prec_sldu_id_toall']+']['+df['prec_usrep_id_toall']+']'
     
     return df['prec_id_sldl_sldu_usrep']
 
+@instrumented
 def prec_split_check(sos_df, sos_precinct_id, vest_df, vest_precinct_id, sldl_dist_col, sldu_dist_col, usrep_dist_col, prec_id_sldl_sldu_usrep):
     
     '''Purpose: Make sure that the precinct IDs selected from SOS and VEST are the *unique* identifiers 
@@ -123,8 +761,285 @@ def prec_split_check(sos_df, sos_precinct_id, vest_df, vest_precinct_id, sldl_di
         print('Split occurred!')
     elif (vest_df[vest_precinct_id].nunique()!=sos_df[sos_precinct_id].nunique()):
         print('unique id counts do not match!')
+
+@instrumented
+def precinct_district_splits(df, precinct_key_col, sldl_dist_col, sldu_dist_col, usrep_dist_col, na_value='NA'):
+    
+    '''Purpose: find the precincts listed with more than one state leg or congressional district,
+    without adding any columns to df (replaces mk_precinct_district_id for split checks)
+    
+    Arguments:
+        df: election results dataframe, pre-pivot
+        precinct_key_col: unique precinct identifier - number or name
+        sldl_dist_col, sldu_dist_col, usrep_dist_col: district # cols - listed in df with corresponding precinct key
+        na_value: value used in the district cols for rows without that office
+    
+    Returns:
+        split_precincts: {precinct: {'SLDL'/'SLDU'/'USREP': sorted list of districts}} for the levels each split precinct is split at
+        district_counts: DataFrame with one row per precinct and the number of distinct SLDL, SLDU and USREP districts
+    '''
+    
+    level_cols = {'SLDL': sldl_dist_col, 'SLDU': sldu_dist_col, 'USREP': usrep_dist_col}
+    dist_cols = list(level_cols.values())
+    #Distinct districts per precinct, not counting na_value - one column at a time, so only that column's
+    #rows with an office are selected instead of masking a copy of every district column
+    precincts = df.groupby(precinct_key_col,observed=True).size().index
+    district_counts = pd.DataFrame(index=precincts)
+    for level, col in level_cols.items():
+        has_office = (df[col] != na_value).to_numpy()
+        district_counts[level] = (df.loc[has_office, col].groupby(df.loc[has_office, precinct_key_col],observed=True).nunique()
+                                  .reindex(precincts, fill_value=0))
+    split_mask = (district_counts > 1).any(axis=1)
+    
+    #District lists only for the split precincts
+    split_rows = df.loc[df[precinct_key_col].isin(district_counts.index[split_mask]), [precinct_key_col]+dist_cols]
+    split_precincts = {precinct: {} for precinct in district_counts.index[split_mask]}
+    for level, col in level_cols.items():
+        split_at_level = district_counts.index[district_counts[level] > 1]
+        level_rows = split_rows.loc[split_rows[precinct_key_col].isin(split_at_level) & (split_rows[col] != na_value), [precinct_key_col, col]]
+        for precinct, districts in level_rows.drop_duplicates().groupby(precinct_key_col,observed=True)[col]:
+            split_precincts[precinct][level] = sorted(districts)
+    return split_precincts, district_counts
+
+@instrumented
+def prec_split_check_grouped(sos_df, sos_precinct_id, vest_df, vest_precinct_id, sldl_dist_col, sldu_dist_col, usrep_dist_col, na_value='NA'):
+    
+    '''Purpose: same check as prec_split_check using precinct_district_splits, without adding columns to sos_df.
+    Returns the split_precincts dictionary from precinct_district_splits
+    '''
+    
+    split_precincts, district_counts = precinct_district_splits(sos_df, sos_precinct_id, sldl_dist_col, sldu_dist_col, usrep_dist_col, na_value)
+    vest_count = vest_df[vest_precinct_id].nunique()
+    sos_count = len(district_counts.index)
+    print('# vest unique precinct ids: ', vest_count, '\n # sos unique precinct ids: ', sos_count, 
+          '\n # sos precincts split by districts: ', len(split_precincts))
+    if (vest_count==sos_count)&(len(split_precincts)==0):
+        print('Counts match - no splits occurred!')
+    elif (vest_count==sos_count):
+        print('Split occurred!')
+    else:
+        print('unique id counts do not match!')
+    return split_precincts
         
         
+#Precinct name matching, for building the SOS to VEST join
+
+#Word: replacement applied when normalizing precinct names (after upper-casing and removing punctuation), '' drops the word
+PRECINCT_NAME_ABBREVIATIONS = {'PRECINCT': 'PCT', 'PREC': 'PCT', 'PCTS': 'PCT', 'WARD': 'WD', 'TOWNSHIP': 'TWP', 'TOWN': 'TWP',
+                               'VILLAGE': 'VLG', 'DISTRICT': 'DIST', 'NUMBER': '', 'NO': '', 'NUM': '', 'THE': '', 'OF': '',
+                               'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W', 'SAINT': 'ST', 'MOUNT': 'MT', 'FORT': 'FT', '&': 'AND'}
+
+def normalize_precinct_names(names, abbreviations=PRECINCT_NAME_ABBREVIATIONS):
+    '''Purpose: put precinct names in one standard form so the same precinct is spelled the same way in the SOS and VEST data:
+    upper case, accents and punctuation removed, common words abbreviated (see PRECINCT_NAME_ABBREVIATIONS), leading zeros dropped
+    from numbers, ex: "Precinct No. 007-A" -> "PCT 7 A". Each unique name is normalized once.
+    Returns a Series of normalized names with the index of names ('' for missing names)
+    '''
+
+    names = pd.Series(names)
+    codes, uniques = pd.factorize(names)
+    text = pd.Series(uniques.astype(str), dtype=object)
+    text = text.str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii').str.upper().str.replace("'", "", regex=False)
+    text = text.str.replace(r"(?<=[A-Z])(?=[0-9])|(?<=[0-9])(?=[A-Z])", " ", regex=True).str.replace(r"[^A-Z0-9&]+", " ", regex=True)
+    words = r"(?<![A-Z0-9])(?:"+"|".join(re.escape(word) for word in sorted(abbreviations, key=len, reverse=True))+r")(?![A-Z0-9])"
+    text = text.str.replace(words, lambda match: " "+abbreviations[match.group(0)]+" ", regex=True)
+    text = text.str.replace(r"(?<![A-Z0-9])0+(?=[0-9])", "", regex=True).str.split().str.join(" ")
+    return pd.Series(np.append(text.to_numpy(dtype=object), '')[codes], index=names.index)
+
+def precinct_name_ngrams(names, n=3):
+    '''Purpose: the distinct character n-grams of every name (padded with a space on each side), for the matching index
+    Returns DataFrame with the row (position in names) and gram of every distinct n-gram of every name, in row order
+    '''
+
+    rows = []
+    grams = []
+    for row, name in enumerate(names):
+        padded = ' '+name+' '
+        name_grams = {padded[i:i+n] for i in range(max(len(padded)-n+1, 1))}
+        rows += [row]*len(name_grams)
+        grams += name_grams
+    return pd.DataFrame({'row': np.array(rows, dtype=np.int64), 'gram': np.array(grams, dtype=object)})
+
+def rank_within_groups(sorted_groups):
+    '''Purpose: position of every element within its run of equal values, for an array sorted by group
+    '''
+
+    sorted_groups = np.asarray(sorted_groups)
+    positions = np.arange(len(sorted_groups))
+    starts = np.ones(len(sorted_groups), dtype=bool)
+    starts[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    return positions - np.maximum.accumulate(np.where(starts, positions, 0))
+
+def expand_ranges(starts, counts):
+    '''Purpose: the indices starts[i], starts[i]+1, ..., starts[i]+counts[i]-1 of every range, concatenated
+    '''
+
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+@instrumented
+def match_precinct_names(source_df, source_name_col, partner_df, partner_name_col, source_county_col=None, partner_county_col=None,
+                         min_score=.5, n=3, max_postings=200, candidate_grams=6, max_candidates=5, batch_size=20000):
+    '''Purpose: match SOS precincts to VEST precincts by name, to build the join that precinct_votes_check expects
+    1) names are normalized (normalize_precinct_names) and names that are identical and unique within their county match with a score of 1
+    2) the rest are scored with a character n-gram inverted index, within their county only: each n-gram is weighted by how rare it is
+        in the county, each SOS name looks up the VEST names sharing its rarest n-grams, and only the best of those candidates are
+        scored (cosine similarity of the weighted n-grams) - never all pairs
+    3) each precinct is matched at most once, best scores first, down to min_score
+    Arguments:
+        source_df, source_name_col: SOS results and their precinct name column
+        partner_df, partner_name_col: VEST results and their precinct name column
+        source_county_col, partner_county_col: county columns with the same codes on both sides (ex: COUNTYFP), None to match statewide
+        min_score: lowest similarity (0 to 1) to accept as a match
+        n: n-gram length
+        max_postings: n-grams in more than this many VEST precincts of a county (ex: " PC") are too common to find candidates with
+            (they still count in the scores), keeps large counties fast
+        candidate_grams: number of rarest n-grams of each SOS name used to find its candidates
+        max_candidates: candidates kept per SOS precinct for the one-to-one assignment
+        batch_size: SOS precincts looked up at a time, bounds memory
+    Returns dictionary with:
+        crosswalk: DataFrame with source_index, source_name, partner_index, partner_name, county, score and method ('exact' or 'ngram'),
+            use merge_on_crosswalk to join the two DataFrames with it
+        unmatched_source, unmatched_partner: the rows of source_df and partner_df that weren't matched
+    '''
+
+    n_source = len(source_df.index)
+    n_partner = len(partner_df.index)
+    source_county = source_df[source_county_col].astype(str).to_numpy() if source_county_col else np.full(n_source, '')
+    partner_county = partner_df[partner_county_col].astype(str).to_numpy() if partner_county_col else np.full(n_partner, '')
+    #Counties and normalized names as integer codes shared by both sides, partner rows after the source rows
+    county_codes, counties = pd.factorize(np.concatenate([source_county, partner_county]))
+    names = np.concatenate([normalize_precinct_names(source_df[source_name_col]).to_numpy(), normalize_precinct_names(partner_df[partner_name_col]).to_numpy()])
+    name_codes, unique_names = pd.factorize(names)
+    county_name = county_codes.astype(np.int64)*len(unique_names) + name_codes
+
+    #Exact pass: normalized names that are unique within their county on both sides
+    source_unique = np.flatnonzero(~pd.Series(county_name[:n_source]).duplicated(keep=False).to_numpy())
+    partner_unique = np.flatnonzero(~pd.Series(county_name[n_source:]).duplicated(keep=False).to_numpy())
+    exact_partner = pd.Series(partner_unique, index=county_name[n_source:][partner_unique]).reindex(county_name[source_unique]).to_numpy()
+    found = ~np.isnan(exact_partner)
+    exact_source_rows = source_unique[found]
+    exact_partner_rows = exact_partner[found].astype(np.int64)
+    source_left = np.setdiff1d(np.arange(n_source), exact_source_rows)
+    partner_left = np.setdiff1d(np.arange(n_partner), exact_partner_rows)
+
+    #N-gram pass on the rest: (county, n-gram) keys, weighted by the inverse document frequency of the n-gram in its county
+    source_grams = precinct_name_ngrams(names[source_left], n)
+    partner_grams = precinct_name_ngrams(names[n_source+partner_left], n)
+    source_row = source_left[source_grams['row'].to_numpy()]
+    partner_row = partner_left[partner_grams['row'].to_numpy()]
+    gram_codes, unique_grams = pd.factorize(np.concatenate([source_grams['gram'].to_numpy(), partner_grams['gram'].to_numpy()]))
+    gram_county = np.concatenate([county_codes[source_row], county_codes[n_source+partner_row]]).astype(np.int64)
+    key_codes, keys = pd.factorize(gram_county*len(unique_grams) + gram_codes)
+    county_size = np.bincount(np.concatenate([county_codes[source_left], county_codes[n_source+partner_left]]), minlength=len(counties))
+    weight = (np.log((county_size[keys//max(len(unique_grams), 1)]+1)/np.bincount(key_codes, minlength=len(keys)))+1)**2
+    source_key = key_codes[:len(source_row)]
+    partner_key = key_codes[len(source_row):]
+    source_norm = np.sqrt(np.bincount(source_row, weights=weight[source_key], minlength=n_source))
+    partner_norm = np.sqrt(np.bincount(partner_row, weights=weight[partner_key], minlength=n_partner))
+
+    #The inverted index: VEST precincts sorted by (county, n-gram) key, without the keys too common to narrow anything down
+    indexed = np.bincount(partner_key, minlength=len(keys))[partner_key] <= max_postings
+    index_order = np.argsort(partner_key[indexed], kind='stable')
+    index_keys = partner_key[indexed][index_order]
+    index_rows = partner_row[indexed][index_order]
+    #Every VEST (precinct, key) pair as one sorted number, to find the shared n-grams when scoring
+    partner_pairs = np.sort(partner_row.astype(np.int64)*len(keys) + partner_key)
+    #The candidate_grams rarest n-grams of every SOS name, in row order
+    probe_order = np.lexsort((-weight[source_key], source_row))
+    probe_order = probe_order[rank_within_groups(source_row[probe_order]) < candidate_grams]
+    probe_row = source_row[probe_order]
+    probe_key = source_key[probe_order]
+
+    candidate_source, candidate_partner, candidate_score = [], [], []
+    for start in range(0, len(source_left), batch_size):
+        rows = source_left[start:start+batch_size]
+        lo, hi = np.searchsorted(probe_row, rows[0], 'left'), np.searchsorted(probe_row, rows[-1], 'right')
+        #Look up the SOS n-grams in the index, and add up the weights of the n-grams each (SOS, VEST) pair shares
+        first = np.searchsorted(index_keys, probe_key[lo:hi], 'left')
+        counts = np.searchsorted(index_keys, probe_key[lo:hi], 'right') - first
+        hits = np.repeat(probe_row[lo:hi].astype(np.int64)*n_partner, counts) + index_rows[expand_ranges(first, counts)]
+        pairs, pair_of_hit = np.unique(hits, return_inverse=True)
+        partial = np.bincount(pair_of_hit, weights=np.repeat(weight[probe_key[lo:hi]], counts), minlength=len(pairs))
+        pair_source, pair_partner = pairs//n_partner, pairs % n_partner
+        #Exact score for the best few pairs of every SOS precinct: look up all of its n-grams in the VEST pairs
+        best = np.lexsort((-partial, pair_source))
+        best = best[rank_within_groups(pair_source[best]) < 2*max_candidates]
+        pair_source, pair_partner = pair_source[best], pair_partner[best]
+        first = np.searchsorted(source_row, pair_source, 'left')
+        counts = np.searchsorted(source_row, pair_source, 'right') - first
+        gram_index = expand_ranges(first, counts)
+        lookup = np.repeat(pair_partner, counts)*len(keys) + source_key[gram_index]
+        #(searching in sorted order is much faster on large arrays)
+        lookup_order = np.argsort(lookup)
+        found_at = np.minimum(np.searchsorted(partner_pairs, lookup[lookup_order]), len(partner_pairs)-1)
+        shared = np.empty(len(lookup), dtype=bool)
+        shared[lookup_order] = partner_pairs[found_at] == lookup[lookup_order]
+        dot = np.bincount(np.repeat(np.arange(len(pair_source)), counts), weights=weight[source_key[gram_index]]*shared, minlength=len(pair_source))
+        score = dot/source_norm[pair_source]/partner_norm[pair_partner]
+        keep = score >= min_score
+        candidate_source.append(pair_source[keep])
+        candidate_partner.append(pair_partner[keep])
+        candidate_score.append(score[keep])
+    candidates = pd.DataFrame({'row_source': np.concatenate(candidate_source+[np.zeros(0, dtype=np.int64)]),
+                               'row_partner': np.concatenate(candidate_partner+[np.zeros(0, dtype=np.int64)]),
+                               'score': np.concatenate(candidate_score+[np.zeros(0)])})
+    candidates = candidates.sort_values(['score', 'row_source', 'row_partner'], ascending=[False, True, True])
+    candidates = candidates.groupby('row_source', sort=False).head(max_candidates)
+
+    #One-to-one: best score first
+    taken_source = set()
+    taken_partner = set()
+    ngram_matches = []
+    for source_row, partner_row, score in zip(candidates['row_source'].to_numpy(), candidates['row_partner'].to_numpy(), candidates['score'].to_numpy()):
+        if source_row in taken_source or partner_row in taken_partner:
+            continue
+        taken_source.add(source_row)
+        taken_partner.add(partner_row)
+        ngram_matches.append((source_row, partner_row, min(score, 1.0)))
+    ngram = pd.DataFrame(ngram_matches, columns=['source_row', 'partner_row', 'score'])
+
+    source_rows = np.concatenate([exact_source_rows, ngram['source_row'].to_numpy(dtype=np.int64)])
+    partner_rows = np.concatenate([exact_partner_rows, ngram['partner_row'].to_numpy(dtype=np.int64)])
+    crosswalk = pd.DataFrame({'source_index': source_df.index[source_rows],
+                              'source_name': source_df[source_name_col].to_numpy()[source_rows],
+                              'partner_index': partner_df.index[partner_rows],
+                              'partner_name': partner_df[partner_name_col].to_numpy()[partner_rows],
+                              'county': source_county[source_rows],
+                              'score': np.concatenate([np.ones(len(exact_source_rows)), ngram['score'].to_numpy(dtype=float)]),
+                              'method': ['exact']*len(exact_source_rows)+['ngram']*len(ngram.index)})
+    crosswalk = crosswalk.sort_values(['county', 'source_index'], ignore_index=True)
+    return {'crosswalk': crosswalk,
+            'unmatched_source': source_df[~np.isin(np.arange(n_source), source_rows)],
+            'unmatched_partner': partner_df[~np.isin(np.arange(n_partner), partner_rows)]}
+
+def print_precinct_matches(matches, min_print_score=.9):
+    '''Purpose: summarize match_precinct_names, printing the matches below min_print_score for review and every unmatched precinct
+    '''
+
+    crosswalk = matches['crosswalk']
+    print(str(len(crosswalk.index))+" precincts matched ("+str((crosswalk['method']=='exact').sum())+" exact names, "
+          +str((crosswalk['method']=='ngram').sum())+" by n-gram score)")
+    review = crosswalk[crosswalk['score'] < min_print_score]
+    if len(review.index):
+        print("Matches with a score below "+str(min_print_score)+" to review:")
+        for source_name, partner_name, score in zip(review['source_name'], review['partner_name'], review['score']):
+            print("\t"+"{:.2f}".format(score)+" SOURCES: "+str(source_name)+" -> VEST: "+str(partner_name))
+    print(str(len(matches['unmatched_source'].index))+" SOURCES precincts unmatched, "+str(len(matches['unmatched_partner'].index))+" VEST precincts unmatched")
+
+def merge_on_crosswalk(partner_df, source_df, crosswalk):
+    '''Purpose: join VEST and SOS results with a match_precinct_names crosswalk, VEST on the left,
+    with the same "_x"/"_y" suffixes as pd.merge so the result can go straight to precinct_votes_check(merged_df, column_list, True, ...)
+    Returns DataFrame with one row per crosswalk row and a match_score column
+    '''
+
+    left = partner_df.loc[crosswalk['partner_index']].reset_index(drop=True)
+    right = source_df.loc[crosswalk['source_index']].reset_index(drop=True)
+    merged = left.join(right, lsuffix='_x', rsuffix='_y')
+    merged['match_score'] = crosswalk['score'].to_numpy()
+    return merged
+
+@instrumented
 def statewide_totals_check(partner_df,source_df,column_list):
     """Compares the totals of two election result dataframes at the statewide total level
 
@@ -146,135 +1061,1102 @@ def statewide_totals_check(partner_df,source_df,column_list):
             print(race + " is equal", "\tVEST / RDH: " + str(partner_df[race].sum()))
             
             
+@instrumented
+def county_totals_diff(partner_df,source_df,column_list,county_col):
+    """Compares the totals of two election result dataframes at the county level, for every race at once
+
+    Each dataframe is grouped by county a single time, and the two sets of totals are aligned into one difference matrix
+
+    Args:
+      partner_df: DataFrame of election results we are comparing against
+      source_df: DataFrame of election results we are comparing to
+      column_list: List of races that there are votes for
+      county_col: String of the column name that contains county information
+
+    Returns:
+      Tidy DataFrame with one row per race and county (race order, then sorted counties) and columns:
+        county_col, race, vest, source, diff (vest minus source, NaN if the county is missing from one side)
+    """
+    vest_totals = signed_vote_totals(grouped_vote_totals(partner_df, column_list, [county_col]))
+    source_totals = signed_vote_totals(grouped_vote_totals(source_df, column_list, [county_col]))
+    return tidy_county_totals(vest_totals, source_totals, county_col)
+
+
+def tidy_county_totals(vest_totals, source_totals, county_col):
+    """Aligns (county x race) VEST and SOURCES totals into the tidy county_totals_diff DataFrame
+
+    Args:
+      vest_totals, source_totals: DataFrames of totals indexed by county, with the same race columns
+      county_col: String of the name to give the county column
+
+    Returns:
+      See county_totals_diff
+    """
+    column_list = list(vest_totals.columns)
+    counties = vest_totals.index.union(source_totals.index)
+    if (len(counties) != len(vest_totals.index)):
+        vest_totals = vest_totals.reindex(counties)
+    if (len(counties) != len(source_totals.index)):
+        source_totals = source_totals.reindex(counties)
+    #Flatten column by column so each race's counties stay together
+    vest = vest_totals.to_numpy().ravel(order="F")
+    source = source_totals.to_numpy().ravel(order="F")
+    return pd.DataFrame({county_col:np.tile(counties.to_numpy(),len(column_list)),
+                         "race":np.repeat(np.array(column_list,dtype=object),len(counties)),
+                         "vest":vest,
+                         "source":source,
+                         "diff":vest-source})
+
+
+def print_county_totals_diff(county_diff,full_print=False):
+    """Prints the results of county_totals_diff as the county_totals_check analysis
+
+    Args:
+      county_diff: DataFrame returned by county_totals_diff
+      full_print: Boolean specifying whether to print out everything, including counties w/ similarities
+
+    Returns:
+      Nothing, only prints out an analysis
+    """
+    county_col = county_diff.columns[0]
+    print("***Countywide Totals Check***")
+    print("")
+    differs = county_diff["diff"] != 0
+    for race, race_diff in county_diff.groupby("race",sort=False):
+        race_differs = differs[race_diff.index]
+        if (race_differs.any()):
+            print(race + " contains differences in these counties:")
+            for county, diff, vest, source in race_diff.loc[race_differs,[county_col,"diff","vest","source"]].itertuples(index=False):
+                print("\t"+str(county)+" has a difference of "+str(diff)+" votes")
+                print("\t\tVEST: "+str(vest)+" votes")
+                print("\t\tSOURCES: "+str(source)+" votes")
+        else:
+            print(race + " is equal across all counties")
+        if (full_print):
+            for county, vest in race_diff.loc[~race_differs,[county_col,"vest"]].itertuples(index=False):
+                print("\t"+str(county) + ": "+ str(vest)+" votes")
+    diff_counties = list(county_diff.loc[differs,county_col].unique())
+    if (len(diff_counties)>0):
+        print()
+        print(diff_counties)
+
+
+@instrumented
 def county_totals_check(partner_df,source_df,column_list,county_col,full_print=False):
     """Compares the totals of two election result dataframes at the county level
 
-    Args:
-      partner_df: DataFrame of election results we are comparing against
-      source_df: DataFrame of election results we are comparing to
-      column_list: List of races that there are votes for
-      county_col: String of the column name that contains county information
-      full_print: Boolean specifying whether to print out everything, including counties w/ similarities
+    Args:
+      partner_df: DataFrame of election results we are comparing against
+      source_df: DataFrame of election results we are comparing to
+      column_list: List of races that there are votes for
+      county_col: String of the column name that contains county information
+      full_print: Boolean specifying whether to print out everything, including counties w/ similarities
+
+    Returns:
+      Prints out an analysis and returns the county_totals_diff DataFrame of (county, race, vest, source, diff)
+    """
+
+    county_diff = county_totals_diff(partner_df,source_df,column_list,county_col)
+    print_county_totals_diff(county_diff,full_print)
+    return county_diff
+        
+        
+@instrumented
+def precinct_votes_check(merged_df,column_list,vest_on_left,name_col,print_level=0):
+    """Checks a merged dataframe with two election results at the precinct level
+
+    Args:
+      merged_df: DataFrame with one set of election results joined to another
+      column_list: List of races that there are votes for
+      vest_on_left: Boolean specifying whether VEST data is on the left side of merged_df
+      name_col: String of the column name to refer to precincts when a difference occurs
+      print_level: Integer that specifies how large the vote difference in a precinct must be to be printed
+
+    Returns:
+      Nothing, only prints out an analysis
+    """
+    merged_df = merged_df.sort_values(by=[name_col],inplace=False)
+    matching_rows = 0
+    different_rows = 0
+    diff_list=[]
+    diff_values = []
+    max_diff = 0
+    for index,row in merged_df.iterrows():
+        same = True
+        for i in column_list:
+            left_data = i + "_x"
+            right_data = i + "_y"
+            if ((row[left_data] is None) or (row[right_data] is None) or (np.isnan(row[right_data])or(np.isnan(row[left_data])))):
+                print("FIX NaN value at: ", row[name_col])
+                count_fallback("nan_values")
+                return;
+            diff = abs(row[left_data]-row[right_data])
+            if (diff>0):
+                same = False
+                diff_values.append(abs(diff))
+                if (diff>max_diff):
+                    max_diff = diff
+            if(diff>print_level):
+                if (vest_on_left):
+                    print(i, "{:.>72}".format(row[name_col]), "(V)","{:.>5}".format(int(row[left_data]))," (S){:.>5}".format(int(row[right_data])),"(D):{:>5}".format(int(row[left_data]-row[right_data])))                           
+                else:
+                    print(i, "{:.>72}".format(row[name_col]), "(S)","{:.>5}".format(int(row[left_data]))," (V){:.>5}".format(int(row[right_data])),"(D):{:>5}".format(int(row[left_data]-row[right_data])))
+        if(same != True):
+            different_rows +=1
+            diff_list.append(row[name_col])
+        else:
+            matching_rows +=1
+    print("")
+    print("There are ", len(merged_df.index)," total rows")
+    print(different_rows," of these rows have election result differences")
+    print(matching_rows," of these rows are the same")
+    print("")
+    print("The max difference between any one shared column in a row is: ", max_diff)
+    if(len(diff_values)!=0):
+        print("The average difference is: ", str(sum(diff_values)/len(diff_values)))
+    count_big_diff = len([i for i in diff_values if i > 10])
+    print("There are ", str(count_big_diff), "precinct results with a difference greater than 10")
+    print("")
+    print("All precincts containing differences:")
+    diff_list.sort()
+    print(diff_list)
+
+
+@instrumented
+def precinct_votes_diff(merged_df,column_list,vest_on_left,name_col,threshold=10):
+    """Vectorized version of precinct_votes_check that returns the differences instead of printing them
+
+    All of the "_x" and "_y" columns are compared at once as two (precinct x race) arrays
+
+    Args:
+      merged_df: DataFrame with one set of election results joined to another
+      column_list: List of races that there are votes for
+      vest_on_left: Boolean specifying whether VEST data is on the left side of merged_df
+      name_col: String of the column name to refer to precincts when a difference occurs
+      threshold: Number of votes a precinct result must differ by to be counted in count_big_diff
+
+    Returns:
+      Dictionary with the results of the check, precincts sorted by name_col:
+        differences: DataFrame (precinct x race) of left minus right votes, NaN where either side is missing
+        left_votes, right_votes: DataFrames (precinct x race) of the votes on each side of the merge
+        precinct_diff: Series of the summed absolute difference in each precinct
+        race_diff: Series of the summed absolute difference in each race
+        different_precincts: sorted list of the precincts containing differences
+        total_rows, different_rows, matching_rows: Integer row counts
+        max_diff: Largest absolute difference in any one precinct result, an integer when every difference is whole
+        mean_diff: Average of the non-zero absolute differences, None if there are none
+        count_big_diff: Number of precinct results with a difference greater than threshold
+        nan_locations: DataFrame of name_col, race, left_is_nan, right_is_nan for every missing value
+        threshold, vest_on_left: the arguments used, needed by print_precinct_votes_diff
+      With sparse vote columns (see to_sparse_votes) the differences, left_votes and right_votes DataFrames keep them sparse
+    """
+    merged_df = merged_df.sort_values(by=[name_col],inplace=False)
+    names = merged_df[name_col].to_numpy()
+    if any(is_sparse_vote_column(merged_df[i+suffix]) for i in column_list for suffix in ["_x","_y"]):
+        return summarize_sparse_precinct_votes(names,merged_df[[i+"_x" for i in column_list]],merged_df[[i+"_y" for i in column_list]],
+                                               column_list,vest_on_left,name_col,threshold)
+    left = merged_df[[i+"_x" for i in column_list]].to_numpy(dtype=float)
+    right = merged_df[[i+"_y" for i in column_list]].to_numpy(dtype=float)
+    return summarize_precinct_votes(names,left,right,column_list,vest_on_left,name_col,threshold)
+
+
+def summarize_precinct_votes(names,left,right,column_list,vest_on_left,name_col,threshold=10):
+    """Builds the precinct_votes_diff dictionary from the (precinct x race) votes on each side of the merge
+
+    Args:
+      names: Array of the precinct names, in the order of the rows of left and right
+      left, right: Float arrays (precinct x race) of the left and right votes, NaN where missing
+      column_list, vest_on_left, name_col, threshold: see precinct_votes_diff
+
+    Returns:
+      See precinct_votes_diff
+    """
+    left_nan = np.isnan(left)
+    right_nan = np.isnan(right)
+    nan_rows, nan_cols = np.nonzero(left_nan | right_nan)
+    nan_locations = pd.DataFrame({name_col:names[nan_rows],
+                                  "race":np.array(column_list,dtype=object)[nan_cols],
+                                  "left_is_nan":left_nan[nan_rows,nan_cols],
+                                  "right_is_nan":right_nan[nan_rows,nan_cols]})
+    count_fallback("nan_values", len(nan_locations.index))
+
+    differences = left-right
+    abs_diff = np.nan_to_num(np.abs(differences))
+    nonzero_diff = abs_diff[abs_diff > 0]
+    row_differs = (abs_diff > 0).any(axis=1)
+    max_diff = abs_diff.max() if abs_diff.size else 0
+    #Votes are compared as floats, but whole vote counts print like precinct_votes_check, ex: 5 and not 5.0
+    if (abs_diff == np.floor(abs_diff)).all():
+        max_diff = int(max_diff)
+
+    return {"differences":pd.DataFrame(differences,index=names,columns=column_list),
+            "left_votes":pd.DataFrame(left,index=names,columns=column_list),
+            "right_votes":pd.DataFrame(right,index=names,columns=column_list),
+            "precinct_diff":pd.Series(abs_diff.sum(axis=1),index=names),
+            "race_diff":pd.Series(abs_diff.sum(axis=0),index=column_list),
+            "different_precincts":sorted(names[row_differs]),
+            "total_rows":len(names),
+            "different_rows":int(row_differs.sum()),
+            "matching_rows":int((~row_differs).sum()),
+            "max_diff":max_diff,
+            "mean_diff":nonzero_diff.mean() if nonzero_diff.size else None,
+            "count_big_diff":int((abs_diff > threshold).sum()),
+            "nan_locations":nan_locations,
+            "threshold":threshold,
+            "vest_on_left":vest_on_left}
+
+
+def summarize_sparse_precinct_votes(names,left_votes,right_votes,column_list,vest_on_left,name_col,threshold=10):
+    """Builds the precinct_votes_diff dictionary from the nonzero (and NaN) votes on each side of the merge, for sparse vote columns
+    (see to_sparse_votes), without the dense (precinct x race) arrays of summarize_precinct_votes
+
+    Args:
+      names: Array of the precinct names, in the order of the rows of left_votes and right_votes
+      left_votes, right_votes: DataFrames (precinct x race, in column_list order) of the left and right votes, NaN where missing
+      column_list, vest_on_left, name_col, threshold: see precinct_votes_diff
+
+    Returns:
+      See precinct_votes_diff, with the sparse columns of left_votes and right_votes kept sparse in all three DataFrames
+    """
+    n_races = len(column_list)
+    left_rows, left_cols, left_values = nonzero_votes(left_votes, list(left_votes.columns))
+    right_rows, right_cols, right_values = nonzero_votes(right_votes, list(right_votes.columns))
+    #Every (precinct, race) result that isn't 0 on both sides, in row order like np.nonzero
+    left_keys = left_rows*n_races+left_cols
+    right_keys = right_rows*n_races+right_cols
+    keys = np.union1d(left_keys, right_keys)
+    left = np.zeros(len(keys))
+    left[np.searchsorted(keys, left_keys)] = left_values
+    right = np.zeros(len(keys))
+    right[np.searchsorted(keys, right_keys)] = right_values
+    rows, cols = np.divmod(keys, n_races)
+
+    left_nan = np.isnan(left)
+    right_nan = np.isnan(right)
+    nan = left_nan | right_nan
+    nan_locations = pd.DataFrame({name_col:names[rows[nan]],
+                                  "race":np.array(column_list,dtype=object)[cols[nan]],
+                                  "left_is_nan":left_nan[nan],
+                                  "right_is_nan":right_nan[nan]})
+    count_fallback("nan_values", len(nan_locations.index))
+
+    differences = left-right
+    abs_diff = np.nan_to_num(np.abs(differences))
+    nonzero_diff = abs_diff[abs_diff > 0]
+    row_differs = np.bincount(rows[abs_diff > 0], minlength=len(names)) > 0
+    max_diff = abs_diff.max() if abs_diff.size else 0
+    #Votes are compared as floats, but whole vote counts print like precinct_votes_check, ex: 5 and not 5.0
+    if (abs_diff == np.floor(abs_diff)).all():
+        max_diff = int(max_diff)
+
+    #The differences are rebuilt one race at a time, sparse where either side is sparse (like widen_field_totals)
+    col_order = np.argsort(cols, kind="stable")
+    col_starts = np.searchsorted(cols[col_order], np.arange(n_races+1))
+    difference_columns = {}
+    for j, race in enumerate(column_list):
+        column = np.zeros(len(names))
+        column[rows[col_order[col_starts[j]:col_starts[j+1]]]] = differences[col_order[col_starts[j]:col_starts[j+1]]]
+        sparse = is_sparse_vote_column(left_votes.iloc[:,j]) or is_sparse_vote_column(right_votes.iloc[:,j])
+        difference_columns[race] = pd.arrays.SparseArray(column, fill_value=0) if sparse else column
+    #Float votes like summarize_precinct_votes (the merge already makes most of them float)
+    float_dtypes = lambda votes: {col: pd.SparseDtype(float, dtype.fill_value) if isinstance(dtype, pd.SparseDtype) else float
+                                  for col, dtype in votes.dtypes.items() if (dtype.subtype if isinstance(dtype, pd.SparseDtype) else dtype) != float}
+
+    return {"differences":pd.DataFrame(difference_columns,index=names),
+            "left_votes":left_votes.astype(float_dtypes(left_votes)).set_axis(column_list,axis=1).set_axis(names,axis=0),
+            "right_votes":right_votes.astype(float_dtypes(right_votes)).set_axis(column_list,axis=1).set_axis(names,axis=0),
+            "precinct_diff":pd.Series(np.bincount(rows, weights=abs_diff, minlength=len(names)),index=names),
+            "race_diff":pd.Series(np.bincount(cols, weights=abs_diff, minlength=n_races),index=column_list),
+            "different_precincts":sorted(names[row_differs]),
+            "total_rows":len(names),
+            "different_rows":int(row_differs.sum()),
+            "matching_rows":int((~row_differs).sum()),
+            "max_diff":max_diff,
+            "mean_diff":nonzero_diff.mean() if nonzero_diff.size else None,
+            "count_big_diff":int((abs_diff > threshold).sum()),
+            "nan_locations":nan_locations,
+            "threshold":threshold,
+            "vest_on_left":vest_on_left}
+
+
+def print_precinct_votes_diff(precinct_diff,print_level=0):
+    """Prints the results of precinct_votes_diff in the same format as precinct_votes_check
+
+    Args:
+      precinct_diff: Dictionary returned by precinct_votes_diff
+      print_level: Integer that specifies how large the vote difference in a precinct must be to be printed
+
+    Returns:
+      Nothing, only prints out an analysis
+    """
+    nan_locations = precinct_diff["nan_locations"]
+    if (len(nan_locations.index)!=0):
+        for name in nan_locations.iloc[:,0].unique():
+            print("FIX NaN value at: ", name)
+        return
+    left_label, right_label = ("(V)"," (S)") if precinct_diff["vest_on_left"] else ("(S)"," (V)")
+    differences = precinct_diff["differences"]
+    #Only the nonzero differences are read, so sparse differences (see summarize_sparse_precinct_votes) aren't densified
+    rows, cols, diffs = nonzero_votes(differences, list(differences.columns))
+    printed = np.abs(diffs) > print_level
+    for row, col in zip(rows[printed], cols[printed]):
+        left_votes = precinct_diff["left_votes"].iat[row,col]
+        right_votes = precinct_diff["right_votes"].iat[row,col]
+        print(differences.columns[col], "{:.>72}".format(differences.index[row]), left_label,"{:.>5}".format(int(left_votes)),
+              right_label+"{:.>5}".format(int(right_votes)),"(D):{:>5}".format(int(left_votes-right_votes)))
+    print("")
+    print("There are ", precinct_diff["total_rows"]," total rows")
+    print(precinct_diff["different_rows"]," of these rows have election result differences")
+    print(precinct_diff["matching_rows"]," of these rows are the same")
+    print("")
+    print("The max difference between any one shared column in a row is: ", precinct_diff["max_diff"])
+    if (precinct_diff["mean_diff"] is not None):
+        print("The average difference is: ", str(precinct_diff["mean_diff"]))
+    print("There are ", str(precinct_diff["count_big_diff"]), "precinct results with a difference greater than "+str(precinct_diff["threshold"]))
+    print("")
+    print("All precincts containing differences:")
+    print(precinct_diff["different_precincts"])
+
+
+def tidy_discrepancies(vest,source):
+    """Turns aligned (group x race) VEST and SOURCES totals into a tidy DataFrame of the non-zero differences
+
+    Args:
+      vest: DataFrame of VEST totals, indexed by group (a MultiIndex is expanded into one column per level)
+      source: DataFrame of SOURCES totals with the same index and columns as vest
+
+    Returns:
+      DataFrame with the group column(s), race, vest, source and diff for every group and race that differ
+    """
+    diff = vest.to_numpy()-source.to_numpy()
+    rows, cols = np.nonzero(diff != 0)
+    discrepancies = vest.index[rows].to_frame(index=False)
+    discrepancies["race"] = vest.columns[cols].to_numpy(dtype=object)
+    discrepancies["vest"] = vest.to_numpy()[rows,cols]
+    discrepancies["source"] = source.to_numpy()[rows,cols]
+    discrepancies["diff"] = diff[rows,cols]
+    return discrepancies
+
+
+@instrumented
+def reconcile_totals(partner_df,source_df,column_list,precinct_col,levels):
+    """Compares the totals of two election result dataframes at the state, precinct and every other given level in one pass
+
+    Each dataframe is grouped a single time, by precinct and the level columns. Every higher level
+    (county, CONG/SLDL/SLDU district, state) is then summed from those precinct totals instead of from the full data
+
+    Args:
+      partner_df: DataFrame of election results we are comparing against
+      source_df: DataFrame of election results we are comparing to
+      column_list: List of races that there are votes for
+      precinct_col: String of the column name that identifies precincts in both dataframes
+      levels: List of column names to group by between the state and the precincts, ex: ['COUNTYFP','CONG_DIST','SLDU_DIST','SLDL_DIST']
+        Precincts assigned to different groups in the two dataframes show up as separate precinct rows
+
+    Returns:
+      Dictionary with the report, to be used with drill_down_totals and print_totals_reconciliation:
+        levels: List of the levels, top-down: 'state', the given levels, then precinct_col
+        totals: Dictionary of level to a dictionary of (group x race) 'vest', 'source' and 'diff' DataFrames
+        discrepancies: Dictionary of level to a tidy DataFrame of the groups and races that differ. Every level is
+          grouped with the levels above it, ex: 'CONG_DIST' by COUNTYFP and CONG_DIST, so each group can be traced
+          to its parents (the precinct_col DataFrame has every level column)
+        precincts: DataFrame of every precinct with in_vest and in_source booleans
+    """
+    keys = [precinct_col]+levels
+    vest_precincts = signed_vote_totals(grouped_vote_totals(partner_df, column_list, keys, dropna=False))
+    source_precincts = signed_vote_totals(grouped_vote_totals(source_df, column_list, keys, dropna=False))
+    precinct_index = vest_precincts.index.union(source_precincts.index)
+    precincts = precinct_index.to_frame(index=False)
+    precincts["in_vest"] = precinct_index.isin(vest_precincts.index)
+    precincts["in_source"] = precinct_index.isin(source_precincts.index)
+
+    rollup = {precinct_col:(vest_precincts.reindex(precinct_index,fill_value=0),source_precincts.reindex(precinct_index,fill_value=0))}
+    vest, source = rollup[precinct_col]
+    for level in levels:
+        rollup[level] = (vest.groupby(level=level,dropna=False,observed=True).sum(),source.groupby(level=level,dropna=False,observed=True).sum())
+    state_index = pd.Index(["state"],name="state")
+    rollup["state"] = (pd.DataFrame([vest.sum()],index=state_index),pd.DataFrame([source.sum()],index=state_index))
+
+    totals = {}
+    for level, (level_vest, level_source) in rollup.items():
+        totals[level] = {"vest":level_vest,"source":level_source,"diff":level_vest-level_source}
+    #Grouped with the levels above, so drill_down_totals can narrow each level to one group of its parent
+    discrepancies = {"state":tidy_discrepancies(*rollup["state"])}
+    for position, level in enumerate(levels,start=1):
+        discrepancies[level] = tidy_discrepancies(vest.groupby(level=levels[:position],dropna=False,observed=True).sum(),
+                                                  source.groupby(level=levels[:position],dropna=False,observed=True).sum())
+    discrepancies[precinct_col] = tidy_discrepancies(vest,source)
+
+    return {"levels":["state"]+levels+[precinct_col],
+            "totals":totals,
+            "discrepancies":discrepancies,
+            "precincts":precincts}
+
+
+def drill_down_totals(reconciliation,race,level="state",value=None,parents={}):
+    """Finds the groups one level down that are responsible for a difference in one race
+
+    Args:
+      reconciliation: Dictionary returned by reconcile_totals
+      race: String of the race with a difference
+      level: String of the level the difference was found at, 'state' or one of the levels passed to reconcile_totals
+      value: The group at that level with the difference, ex: the county FIPS code (not needed for 'state')
+      parents: Dictionary of higher levels to their group, to stay in one branch when drilling down more than once,
+        ex: {'COUNTYFP': '001'} when drilling down from a CONG_DIST found under county 001
+
+    Returns:
+      Tuple of the next level in reconciliation['levels'] and a DataFrame of its discrepancies for the race,
+      filtered to the groups under value, ex: the part of each CONG_DIST in that county
+    """
+    levels = reconciliation["levels"]
+    if (level not in levels[:-1]):
+        raise ValueError("Can't drill down from "+str(level)+", use 'state' or one of "+str(levels[1:-1]))
+    lower_level = levels[levels.index(level)+1]
+    groups = dict(parents)
+    if (level != "state"):
+        groups[level] = value
+    return lower_level, filter_discrepancies(reconciliation["discrepancies"][lower_level],race,groups)
+
+
+def filter_discrepancies(discrepancies,race,groups):
+    """Narrows one level's reconcile_totals discrepancies to a race and to the rows in the given groups
+
+    Args:
+      discrepancies: DataFrame from reconcile_totals' discrepancies
+      race: String of the race
+      groups: Dictionary of level column to its group, ex: {'COUNTYFP': '001'} (NaN matches missing groups)
+
+    Returns:
+      The matching rows, with a new index
+    """
+    discrepancies = discrepancies[discrepancies["race"]==race]
+    for group_level, group in groups.items():
+        discrepancies = discrepancies[discrepancies[group_level].isna() if pd.isna(group) else discrepancies[group_level]==group]
+    return discrepancies.reset_index(drop=True)
+
+
+def print_totals_reconciliation(reconciliation):
+    """Prints the results of reconcile_totals top-down, race by race, from the state to the precincts
+
+    Args:
+      reconciliation: Dictionary returned by reconcile_totals
+
+    Returns:
+      Nothing, only prints out an analysis
+    """
+    print("***Totals Reconciliation***")
+    levels = reconciliation["levels"]
+    state = reconciliation["totals"]["state"]
+    races_with_differences = set()
+    for level in levels:
+        races_with_differences.update(reconciliation["discrepancies"][level]["race"])
+    for race in state["vest"].columns:
+        if race not in races_with_differences:
+            print(race + " is equal at every level", "\tVEST / RDH: " + str(state["vest"].at["state",race]))
+            continue
+        print(race+" has a statewide difference of "+str(state["diff"].at["state",race])+" votes")
+        print("\tVEST: "+str(state["vest"].at["state",race])+" votes")
+        print("\tSOURCES: "+str(state["source"].at["state",race])+" votes")
+        print_drill_down(reconciliation,race,"state",None,{},1)
+
+
+def print_drill_down(reconciliation,race,level,value,parents,depth):
+    """Prints the groups one level below a group in a race, each followed by the groups below it, down to the precincts
+    (used by print_totals_reconciliation). Groups without a net difference are still followed when differences below them
+    cancel out, so every precinct discrepancy is printed
+    """
+    levels = reconciliation["levels"]
+    lower_level, lower = drill_down_totals(reconciliation,race,level,value,parents)
+    if (level != "state"):
+        parents = {**parents, level:value}
+    #Groups with a difference at this level, then the groups that only have differences further down
+    below = [filter_discrepancies(reconciliation["discrepancies"][deeper],race,parents)[lower_level] for deeper in levels[levels.index(lower_level)+1:]]
+    groups = pd.unique(pd.concat([lower[lower_level]]+below,ignore_index=True)) if below else lower[lower_level].unique()
+    if (len(groups)==0):
+        return
+    print("\t"*depth+lower_level+" differences:")
+    for group in groups:
+        group_lower = filter_discrepancies(lower,race,{lower_level:group})
+        if (len(group_lower.index)!=0):
+            vest, source, diff = group_lower.loc[0,["vest","source","diff"]]
+            print("\t"*(depth+1)+str(group)+" has a difference of "+str(diff)+" votes (VEST: "+str(vest)+", SOURCES: "+str(source)+")")
+        else:
+            print("\t"*(depth+1)+str(group)+" has no net difference, but differences below it cancel out")
+        if (lower_level != levels[-1]):
+            print_drill_down(reconciliation,race,lower_level,group,parents,depth+2)
+
+
+#Incremental re-checks after a corrected canvass, see start_incremental_checks
+
+def precinct_row_hashes(df,precinct_col,county_col,column_list):
+    """Hashes every row's county and votes, so a later version of the same results can be compared row by row
+
+    Args:
+      df: DataFrame of election results, one row per precinct
+      precinct_col: String of the column name that uniquely identifies a precinct
+      county_col: String of the column name that contains county information
+      column_list: List of races that there are votes for
+
+    Returns:
+      DataFrame indexed by precinct_col with the county and the (uint64) hash of every row
+    """
+    if (df[precinct_col].duplicated().any()):
+        raise ValueError("Duplicate values in "+precinct_col)
+    hashes = pd.util.hash_pandas_object(df[[county_col]+column_list],index=False).to_numpy()
+    return pd.DataFrame({"county":df[county_col].to_numpy(),"hash":hashes},index=pd.Index(df[precinct_col].to_numpy(),name=precinct_col))
+
+
+def changed_rows(old_hashes,new_hashes):
+    """Compares two precinct_row_hashes results
+
+    Returns:
+      Tuple of the precincts added, removed or with a different hash, and the counties they were or are now in
+    """
+    positions = old_hashes.index.get_indexer(new_hashes.index)
+    old_hash = old_hashes["hash"].to_numpy()[positions]
+    changed_new = (positions < 0) | (old_hash != new_hashes["hash"].to_numpy())
+    removed = ~old_hashes.index.isin(new_hashes.index)
+    precincts = new_hashes.index[changed_new].append(old_hashes.index[removed])
+    old_positions = positions[changed_new & (positions >= 0)]
+    counties = pd.unique(np.concatenate([new_hashes["county"].to_numpy()[changed_new],
+                                         old_hashes["county"].to_numpy()[old_positions],
+                                         old_hashes["county"].to_numpy()[removed]]))
+    return precincts, counties
+
+
+def merged_precinct_votes(partner_df,source_df,column_list,precinct_col):
+    """Outer merge of the VEST and SOURCES votes of each precinct, and the (precinct x race) float arrays of both sides
+
+    Returns:
+      Tuple of the sorted precinct names and the VEST and SOURCES arrays (NaN where a precinct is missing on one side)
+    """
+    merged_df = pd.merge(partner_df[[precinct_col]+column_list],source_df[[precinct_col]+column_list],on=precinct_col,how="outer")
+    merged_df = merged_df.sort_values(by=[precinct_col])
+    return (merged_df[precinct_col].to_numpy(),
+            merged_df[[i+"_x" for i in column_list]].to_numpy(dtype=float),
+            merged_df[[i+"_y" for i in column_list]].to_numpy(dtype=float))
+
+
+def precinct_vote_stats(names,left,right,threshold):
+    """Per-precinct pieces of the precinct_votes_diff summary, kept by the incremental checks so the summary can be updated
+    from the changed precincts alone
+
+    Returns:
+      DataFrame indexed by names with the max, nonzero_sum, nonzero_count and big_count (above threshold) of each precinct's absolute differences
+    """
+    abs_diff = np.nan_to_num(np.abs(left-right))
+    return pd.DataFrame({"max":abs_diff.max(axis=1,initial=0),
+                         "nonzero_sum":abs_diff.sum(axis=1),
+                         "nonzero_count":(abs_diff > 0).sum(axis=1),
+                         "big_count":(abs_diff > threshold).sum(axis=1)},index=names)
+
+
+@instrumented
+def start_incremental_checks(partner_df,source_df,column_list,precinct_col,county_col,allocating_df=None,threshold=10):
+    """Runs the statewide, county and precinct checks (and the absentee allocation) once, keeping the aggregates and row hashes
+    that update_incremental_checks needs to re-check only the precincts and counties that change afterwards
+
+    Args:
+      partner_df: DataFrame of election results we are comparing against (VEST)
+      source_df: DataFrame of election results we are comparing to, one row per precinct
+      column_list: List of races that there are votes for
+      precinct_col: String of the column name that uniquely identifies a precinct in both DataFrames
+      county_col: String of the column name that contains county information
+      allocating_df: DataFrame of county-level votes to allocate to source_df with allocate_absentee_vectorized, None to compare source_df as is
+      threshold: Number of votes a precinct result must differ by to be counted in count_big_diff
+
+    Returns:
+      Dictionary with the state of the checks (pd.to_pickle it to keep it between sessions):
+        hashes: Dictionary of 'vest', 'source' and 'allocating' precinct_row_hashes of the inputs
+        county_totals: Dictionary of 'vest' and 'source' DataFrames (county x race)
+        statewide: DataFrame (race) of the vest, source and diff totals
+        county_diff: DataFrame returned by county_totals_diff
+        precinct_diff: Dictionary returned by precinct_votes_diff for the outer merge on precinct_col
+        allocated_df, special_allocation: the allocate_absentee_vectorized results, None without allocating_df
+        changed: Dictionary of the precincts and counties re-checked by the last update
+    """
+    state = {"column_list":column_list,"precinct_col":precinct_col,"county_col":county_col,"threshold":threshold,
+             "hashes":{"vest":precinct_row_hashes(partner_df,precinct_col,county_col,column_list),
+                       "source":precinct_row_hashes(source_df,precinct_col,county_col,column_list),
+                       "allocating":None},
+             "allocated_df":None,"special_allocation":None}
+    if allocating_df is not None:
+        state["hashes"]["allocating"] = precinct_row_hashes(allocating_df,county_col,county_col,column_list)
+        source_df, state["special_allocation"] = allocate_absentee_vectorized(source_df,allocating_df,column_list,county_col)
+        state["allocated_df"] = source_df
+    state["county_totals"] = {"vest":signed_vote_totals(grouped_vote_totals(partner_df,column_list,[county_col])),
+                              "source":signed_vote_totals(grouped_vote_totals(source_df,column_list,[county_col]))}
+    names, left, right = merged_precinct_votes(partner_df,source_df,column_list,precinct_col)
+    state["precinct_diff"] = summarize_precinct_votes(names,left,right,column_list,True,precinct_col,threshold)
+    state["precinct_stats"] = precinct_vote_stats(names,left,right,threshold)
+    state["changed"] = {"precincts":list(names),"counties":list(state["county_totals"]["vest"].index.union(state["county_totals"]["source"].index))}
+    update_check_totals(state)
+    return state
+
+
+def update_check_totals(state):
+    """Rebuilds the statewide totals and county_diff of an incremental check state from its (county x race) totals"""
+    vest_totals, source_totals = state["county_totals"]["vest"], state["county_totals"]["source"]
+    state["statewide"] = pd.DataFrame({"vest":vest_totals.sum(),"source":source_totals.sum()})
+    state["statewide"]["diff"] = state["statewide"]["vest"]-state["statewide"]["source"]
+    state["county_diff"] = tidy_county_totals(vest_totals,source_totals,state["county_col"])
+
+
+def replace_county_totals(totals,df,counties,column_list,county_col):
+    """Replaces the rows of a (county x race) totals DataFrame for the given counties with their totals in df"""
+    in_counties = df[county_col].isin(counties).to_numpy()
+    recomputed = signed_vote_totals(grouped_vote_totals(df[in_counties],column_list,[county_col]))
+    totals = pd.concat([totals[~totals.index.isin(counties)],recomputed])
+    return totals.sort_index()
+
+
+@instrumented
+def update_incremental_checks(state,partner_df,source_df,allocating_df=None):
+    """Re-checks new versions of the inputs of start_incremental_checks, ex: after a county issues a corrected canvass
+
+    Only the precincts whose county or votes changed (by their row hash) are merged and compared again, and only the
+    counties they are in are re-grouped (and re-allocated), so a small correction is re-checked in time proportional
+    to the counties it touches, not to the state. The statewide totals are then the sum of the county totals.
+
+    Args:
+      state: Dictionary returned by start_incremental_checks, updated in place
+      partner_df, source_df, allocating_df: the new versions of the DataFrames given to start_incremental_checks
+
+    Returns:
+      The updated state, its 'changed' entry lists the precincts and counties that were re-checked
+    """
+    column_list, precinct_col, county_col = state["column_list"], state["precinct_col"], state["county_col"]
+    new_hashes = {"vest":precinct_row_hashes(partner_df,precinct_col,county_col,column_list),
+                  "source":precinct_row_hashes(source_df,precinct_col,county_col,column_list),
+                  "allocating":None}
+    vest_precincts, vest_counties = changed_rows(state["hashes"]["vest"],new_hashes["vest"])
+    source_precincts, source_counties = changed_rows(state["hashes"]["source"],new_hashes["source"])
+
+    if state["allocated_df"] is not None:
+        if allocating_df is None:
+            raise ValueError("allocating_df is needed to update checks started with an allocating_df")
+        new_hashes["allocating"] = precinct_row_hashes(allocating_df,county_col,county_col,column_list)
+        allocating_precincts, allocating_counties = changed_rows(state["hashes"]["allocating"],new_hashes["allocating"])
+        source_counties = pd.unique(np.concatenate([source_counties,allocating_counties]))
+        #Allocation is done county by county, so re-allocating the affected counties gives the same result as the whole state
+        in_counties = source_df[county_col].isin(source_counties).to_numpy()
+        allocated = state["allocated_df"]
+        if (in_counties.any()):
+            reallocated, special = allocate_absentee_vectorized(source_df[in_counties],allocating_df[allocating_df[county_col].isin(source_counties)],
+                                                                column_list,county_col)
+            allocated = pd.concat([allocated[~allocated[county_col].isin(source_counties).to_numpy()],reallocated])
+            special_allocation = state["special_allocation"]
+            special_allocation = pd.concat([special_allocation[~special_allocation[county_col].isin(source_counties)],special])
+            race_order = {race:i for i, race in enumerate(column_list)}
+            state["special_allocation"] = special_allocation.sort_values([county_col,"race"],kind="stable",
+                                                                         key=lambda col: col.map(race_order) if col.name=="race" else col).reset_index(drop=True)
+        else:
+            allocated = allocated[~allocated[county_col].isin(source_counties).to_numpy()]
+        #Keep the rows in the order of the new source_df
+        allocated = allocated.set_index(precinct_col,drop=False).reindex(source_df[precinct_col].to_numpy())
+        allocated.index = source_df.index
+        state["allocated_df"] = allocated
+        #Every precinct of a re-allocated county may have new votes
+        source_precincts = source_precincts.append(state["hashes"]["source"].index[state["hashes"]["source"]["county"].isin(source_counties)])
+        source_df = allocated
+    state["hashes"] = new_hashes
+
+    #Re-group only the counties with changes
+    state["county_totals"]["vest"] = replace_county_totals(state["county_totals"]["vest"],partner_df,vest_counties,column_list,county_col)
+    state["county_totals"]["source"] = replace_county_totals(state["county_totals"]["source"],source_df,source_counties,column_list,county_col)
+    update_check_totals(state)
+
+    #Compare only the changed precincts again, and put them in place of their previous comparison
+    precincts = vest_precincts.append(source_precincts).unique()
+    names, left, right = merged_precinct_votes(partner_df[partner_df[precinct_col].isin(precincts).to_numpy()],
+                                               source_df[source_df[precinct_col].isin(precincts).to_numpy()],column_list,precinct_col)
+    previous = state["precinct_diff"]
+    positions = previous["left_votes"].index.get_indexer(names)
+    if ((positions >= 0).all() and len(names) == len(precincts)):
+        update_precinct_votes_summary(state,positions,names,left,right)
+    else:
+        #Precincts were added or removed, rebuild the comparison around the unchanged rows
+        keep = ~previous["left_votes"].index.isin(precincts)
+        names = np.concatenate([previous["left_votes"].index.to_numpy()[keep],names])
+        left = np.concatenate([previous["left_votes"].to_numpy()[keep],left])
+        right = np.concatenate([previous["right_votes"].to_numpy()[keep],right])
+        order = np.argsort(names,kind="stable")
+        state["precinct_diff"] = summarize_precinct_votes(names[order],left[order],right[order],column_list,True,precinct_col,state["threshold"])
+        state["precinct_stats"] = precinct_vote_stats(names[order],left[order],right[order],state["threshold"])
+    state["changed"] = {"precincts":sorted(precincts),
+                        "counties":sorted(pd.unique(np.concatenate([vest_counties,source_counties])))}
+    return state
+
+
+def update_precinct_votes_summary(state,positions,names,left,right):
+    """Puts the new comparison of changed precincts that were already compared (at positions) in place in the state's
+    precinct_diff, and updates its summary from the precinct_stats instead of the whole (precinct x race) arrays
+    """
+    precinct_diff, stats = state["precinct_diff"], state["precinct_stats"]
+    column_list, name_col = state["column_list"], state["precinct_col"]
+    old_abs = np.nan_to_num(np.abs(precinct_diff["differences"].to_numpy()[positions]))
+    new_abs = np.nan_to_num(np.abs(left-right))
+    new_stats = precinct_vote_stats(names,left,right,state["threshold"])
+    precinct_diff["differences"].iloc[positions] = left-right
+    precinct_diff["left_votes"].iloc[positions] = left
+    precinct_diff["right_votes"].iloc[positions] = right
+    precinct_diff["precinct_diff"].iloc[positions] = new_stats["nonzero_sum"].to_numpy()
+    precinct_diff["race_diff"] = precinct_diff["race_diff"]-old_abs.sum(axis=0)+new_abs.sum(axis=0)
+    for j, col in enumerate(stats.columns):
+        stats.iloc[positions,j] = new_stats[col].to_numpy()
+
+    left_nan, right_nan = np.isnan(left), np.isnan(right)
+    nan_rows, nan_cols = np.nonzero(left_nan | right_nan)
+    nan_locations = precinct_diff["nan_locations"]
+    nan_locations = pd.concat([nan_locations[~nan_locations[name_col].isin(names)],
+                               pd.DataFrame({name_col:names[nan_rows],
+                                             "race":np.array(column_list,dtype=object)[nan_cols],
+                                             "left_is_nan":left_nan[nan_rows,nan_cols],
+                                             "right_is_nan":right_nan[nan_rows,nan_cols]})])
+    race_order = {race:i for i, race in enumerate(column_list)}
+    precinct_diff["nan_locations"] = nan_locations.sort_values([name_col,"race"],kind="stable",
+                                                               key=lambda col: col.map(race_order) if col.name=="race" else col).reset_index(drop=True)
+
+    row_differs = stats["nonzero_count"].to_numpy() > 0
+    nonzero_count = stats["nonzero_count"].sum()
+    precinct_diff["different_precincts"] = list(stats.index[row_differs])
+    precinct_diff["different_rows"] = int(row_differs.sum())
+    precinct_diff["matching_rows"] = int((~row_differs).sum())
+    precinct_diff["max_diff"] = stats["max"].max() if len(stats.index) else 0
+    precinct_diff["mean_diff"] = stats["nonzero_sum"].sum()/nonzero_count if nonzero_count else None
+    precinct_diff["count_big_diff"] = int(stats["big_count"].sum())
+
+
+def print_incremental_checks(state,print_level=0):
+    """Prints the statewide check, then the county and precinct checks of only what the last update re-checked
+
+    Args:
+      state: Dictionary returned by start_incremental_checks or update_incremental_checks
+      print_level: Integer that specifies how large the vote difference in a precinct must be to be printed
+
+    Returns:
+      Nothing, only prints out an analysis
+    """
+    changed = state["changed"]
+    print("Re-checked "+str(len(changed["precincts"]))+" precincts in "+str(len(changed["counties"]))+" counties")
+    print("")
+    print("***Statewide Totals Check***")
+    for race, vest, source, diff in state["statewide"][["vest","source","diff"]].itertuples():
+        if (diff != 0):
+            print(race+" has a difference of "+str(diff)+" votes")
+            print("\tVEST: "+str(vest)+" votes")
+            print("\tSOURCES: "+str(source)+" votes")
+        else:
+            print(race + " is equal", "\tVEST / RDH: " + str(vest))
+    county_diff = state["county_diff"]
+    print_county_totals_diff(county_diff[county_diff[state["county_col"]].isin(changed["counties"])].reset_index(drop=True))
+    print("")
+    precinct_diff = dict(state["precinct_diff"])
+    for key in ["differences","left_votes","right_votes"]:
+        precinct_diff[key] = precinct_diff[key][precinct_diff[key].index.isin(changed["precincts"])]
+    precinct_diff["nan_locations"] = precinct_diff["nan_locations"][precinct_diff["nan_locations"].iloc[:,0].isin(changed["precincts"])]
+    print_precinct_votes_diff(precinct_diff,print_level)
+
+
+#On-disk cache of expensive geometry steps (reprojection + buffer(0) repair, overlays), see enable_geometry_cache
+#Entries are GeoParquet files named by a content hash of the step's inputs and parameters, file modification time = last use
+_GEOMETRY_CACHE = {"directory": None, "max_mb": 2000}
+
+def enable_geometry_cache(directory=os.path.join(os.path.expanduser("~"), ".cache", "erj_toolbox"), max_mb=2000):
+    '''Purpose: cache the reprojected/repaired geometries of compare_geometries and compare_geometries_vectorized,
+    the area differences of compare_geometries_vectorized and the overlays of district_splits_batch on disk, so rerunning them on unchanged inputs skips the geometry work.
+    Off by default.
+    Arguments:
+        directory: local directory for the cache files, created if needed
+        max_mb: size limit of the cache, the least recently used entries are deleted to stay under it
+    Entries are keyed by a hash of the input geometries, attributes, CRS and parameters, so changed inputs never hit a stale entry.
+    See invalidate_geometry_cache to delete entries and geometry_cache_info to list them
+    '''
+
+    os.makedirs(directory, exist_ok=True)
+    _GEOMETRY_CACHE["directory"] = directory
+    _GEOMETRY_CACHE["max_mb"] = max_mb
+
+def disable_geometry_cache():
+    '''Purpose: stop using the geometry cache (the files are kept, see invalidate_geometry_cache)
+    '''
+
+    _GEOMETRY_CACHE["directory"] = None
+
+def geometry_cache_key(step, *inputs):
+    '''Purpose: content hash for a cached geometry step
+    Arguments:
+        step: name of the step, ex: "reproject_repair"
+        inputs: the step's inputs - (Geo)DataFrames and GeoSeries are hashed by their index, attributes, geometry (as WKB) and CRS,
+            anything else (parameters) by its repr
+    Returns the hex digest, used as the cache file name
+    '''
+
+    import hashlib
+    digest = hashlib.blake2b(step.encode(), digest_size=20)
+    for value in inputs:
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            import shapely
+            frame = value.to_frame() if isinstance(value, pd.Series) else value
+            geometry_cols = [col for col in frame.columns if str(frame[col].dtype) == "geometry"]
+            attributes = frame.drop(columns=geometry_cols)
+            digest.update(repr((list(frame.columns), [str(dtype) for dtype in frame.dtypes])).encode())
+            try:
+                digest.update(pd.util.hash_pandas_object(attributes, index=True).to_numpy().tobytes())
+            except TypeError:
+                digest.update(pd.util.hash_pandas_object(attributes.astype(str), index=True).to_numpy().tobytes())
+            for col in geometry_cols:
+                digest.update(str(frame[col].crs.to_wkt() if frame[col].crs is not None else None).encode())
+                digest.update(b"".join(wkb if wkb is not None else b"\0" for wkb in shapely.to_wkb(frame[col].to_numpy())))
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+def cached_geometry_step(step, compute, *inputs):
+    '''Purpose: return compute() (a GeoDataFrame or DataFrame) from the geometry cache if this step was already run on the same inputs,
+    else run it and store the result. Just runs compute() when the cache is off.
+    Arguments:
+        step: name of the step, ex: "overlay"
+        compute: function with no arguments returning the (Geo)DataFrame
+        inputs: everything the result depends on, see geometry_cache_key
+    '''
+
+    directory = _GEOMETRY_CACHE["directory"]
+    if directory is None:
+        return compute()
+    import geopandas as gp
+    path = os.path.join(directory, step+"-"+geometry_cache_key(step, *inputs)+".parquet")
+    if os.path.exists(path):
+        import pyarrow.parquet as pq
+        try:
+            result = gp.read_parquet(path) if b"geo" in (pq.read_schema(path).metadata or {}) else pd.read_parquet(path)
+        except Exception:
+            #Unreadable entry (ex: left by an older version or a full disk), drop it and recompute
+            count_fallback("geometry_cache_unreadable")
+            os.remove(path)
+        else:
+            os.utime(path)
+            count_cache_hit()
+            return result
+    result = compute()
+    #Written next to the entry and renamed into place, so an interrupted write or a concurrent run never leaves a partial entry
+    import tempfile
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=step+"-", suffix=".tmp")
+    os.close(handle)
+    try:
+        result.to_parquet(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    evict_geometry_cache(_GEOMETRY_CACHE["max_mb"])
+    return result
+
+def geometry_cache_info():
+    '''Purpose: list the entries of the geometry cache
+    Returns DataFrame with the file, step, MB and last_used (most recently used first)
+    '''
+
+    directory = _GEOMETRY_CACHE["directory"]
+    files = [] if directory is None else [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".parquet")]
+    info = pd.DataFrame({"file": files,
+                         "step": [os.path.basename(f).rsplit("-", 1)[0] for f in files],
+                         "MB": [os.path.getsize(f)/1e6 for f in files],
+                         "last_used": pd.to_datetime([os.path.getmtime(f) for f in files], unit="s")})
+    return info.sort_values("last_used", ascending=False, ignore_index=True)
+
+def evict_geometry_cache(max_mb):
+    '''Purpose: delete the least recently used geometry cache entries until the cache is no bigger than max_mb
+    Returns the number of entries deleted
+    '''
+
+    info = geometry_cache_info()
+    over = info[info["MB"].cumsum() > max_mb]
+    for path in over["file"]:
+        os.remove(path)
+    return len(over.index)
+
+def invalidate_geometry_cache(step=None):
+    '''Purpose: delete geometry cache entries, ex: after a GDAL/PROJ upgrade changes reprojection results
+    Arguments:
+        step: only delete the entries of this step (ex: "overlay"), None for every entry
+    Returns the number of entries deleted
+    '''
+
+    info = geometry_cache_info()
+    if step is not None:
+        info = info[info["step"] == step]
+    for path in info["file"]:
+        os.remove(path)
+    return len(info.index)
+
+def reproject_repair(gdf, crs=3857):
+    '''Purpose: gdf reprojected to crs with every geometry repaired by buffer(0), the first step of the geometry comparisons.
+    Cached when the geometry cache is on - only the geometry, index and CRS are hashed, so edits to other columns still hit the cache
+    '''
+
+    import geopandas as gp
+    repaired = cached_geometry_step("reproject_repair", lambda: gdf.geometry.to_crs(crs).buffer(0).to_frame("geometry"), gdf.geometry, crs)
+    result = pd.DataFrame(gdf).copy()
+    result[gdf.geometry.name] = repaired.geometry.to_numpy()
+    return gp.GeoDataFrame(result, geometry=gdf.geometry.name, crs=repaired.crs)
+
+def geometry_fingerprints(geoms):
+    '''Purpose: 16 byte hash of the normalized WKB of every geometry in an array (None for missing geometries),
+    so the same shape gets the same fingerprint whatever its vertex order, ring orientation or starting vertex
+    '''
+
+    import hashlib
+    import shapely
+    wkbs = shapely.to_wkb(shapely.normalize(geoms))
+    return np.array([hashlib.blake2b(wkb, digest_size=16).digest() if wkb is not None else None for wkb in wkbs], dtype=object)
+
+def changed_vertex_area_bounds(left_geoms, right_geoms):
+    '''Purpose: upper bound on the symmetric difference area (compare_geometries units) of each pair of (multi)polygons
+    with the same parts, rings and vertex counts once normalized, ex: the same district with a few vertices moved.
+    Two such shapes can only differ inside the bounding box of each run of changed vertices (with the unchanged
+    vertex on either side, which both shapes share), so the bound is the sum of the areas of those boxes.
+    Returns array of bounds, NaN for pairs without the same structure
+    '''
+
+    import shapely
+    n = len(left_geoms)
+    bounds = np.full(n, np.nan)
+    rings = []
+    for geoms in (shapely.normalize(left_geoms), shapely.normalize(right_geoms)):
+        polygonal = np.isin(shapely.get_type_id(geoms), [3, 6])
+        parts, part_pair = shapely.get_parts(np.where(polygonal, geoms, None), return_index=True)
+        pair_rings, ring_part = shapely.get_rings(parts, return_index=True)
+        rings.append((pair_rings, part_pair[ring_part], polygonal))
+    (left_rings, ring_pair, left_polygonal), (right_rings, right_pair, right_polygonal) = rings
+
+    #Same number of rings, then the same number of vertices in every ring (rings are in the same order once normalized)
+    n_rings = np.bincount(ring_pair, minlength=n)
+    same = left_polygonal & right_polygonal & (n_rings > 0) & (n_rings == np.bincount(right_pair, minlength=n))
+    left_rings, ring_pair, right_rings = left_rings[same[ring_pair]], ring_pair[same[ring_pair]], right_rings[same[right_pair]]
+    lengths = shapely.get_num_coordinates(left_rings)
+    same[ring_pair[lengths != shapely.get_num_coordinates(right_rings)]] = False
+    keep = same[ring_pair]
+    left_rings, right_rings, ring_pair, lengths = left_rings[keep], right_rings[keep], ring_pair[keep], lengths[keep]-1
+    bounds[same] = 0
+    if len(left_rings) == 0:
+        return bounds
+
+    #Vertices without the closing one, each with its ring's previous and next vertex (wrapping around)
+    left_xy, ring_idx = shapely.get_coordinates(left_rings, return_index=True)
+    right_xy = shapely.get_coordinates(right_rings)
+    closing = np.cumsum(lengths+1)-1
+    vertices = np.ones(len(ring_idx), dtype=bool)
+    vertices[closing] = False
+    left_xy, right_xy, ring_idx = left_xy[vertices], right_xy[vertices], ring_idx[vertices]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    vertex = np.arange(len(ring_idx))
+    position = vertex-starts[ring_idx]
+    previous = np.where(position == 0, vertex+lengths[ring_idx]-1, vertex-1)
+    following = np.where(position == lengths[ring_idx]-1, vertex-lengths[ring_idx]+1, vertex+1)
+    changed = (left_xy != right_xy).any(axis=1)
+    in_run = changed | changed[previous] | changed[following]
+    if not in_run.any():
+        return bounds
+
+    #Number the runs of consecutive vertices in a run, the start of a ring continuing the run at its end (a ring with
+    #every vertex in a run is one run starting at its first vertex)
+    run_start = in_run & ~in_run[previous]
+    whole_ring = np.bincount(ring_idx, weights=in_run, minlength=len(lengths)) == lengths
+    run_start[starts[whole_ring]] = True
+    run_id = np.cumsum(run_start)
+    first_start = np.full(len(lengths), np.iinfo(np.int64).max)
+    np.minimum.at(first_start, ring_idx[run_start], position[run_start])
+    last_run = run_id[starts+lengths-1]
+    run_id = np.where(position < first_start[ring_idx], last_run[ring_idx], run_id)[in_run]
 
-    Returns:
-      Nothing, only prints out an analysis
-    """
-    
-    print("***Countywide Totals Check***")
-    print("")
-    diff_counties=[]
-    for race in column_list:
-        diff = partner_df.groupby([county_col]).sum()[race]-source_df.groupby([county_col]).sum()[race]
-        for val in diff[diff != 0].index.values.tolist():
-            if val not in diff_counties:
-                diff_counties.append(val)
-        if len(diff[diff != 0]!=0):   
-            print(race + " contains differences in these counties:")
-            for val in diff[diff != 0].index.values.tolist():
-                county_differences = diff[diff != 0]
-                print("\t"+val+" has a difference of "+str(county_differences[val])+" votes")
-                print("\t\tVEST: "+str(partner_df.groupby([county_col]).sum().loc[val,race])+" votes")
-                print("\t\tSOURCES: "+str(source_df.groupby([county_col]).sum().loc[val,race])+" votes")
-            if (full_print):
-                for val in diff[diff == 0].index.values.tolist():
-                    county_similarities = diff[diff == 0]
-                    print("\t"+val + ": "+ str(partner_df.groupby([county_col]).sum().loc[val,race])+" votes")
-        else:
-            print(race + " is equal across all counties")
-            if (full_print):
-                for val in diff[diff == 0].index.values.tolist():
-                    county_similarities = diff[diff == 0]
-                    print("\t"+val + ": "+ str(partner_df.groupby([county_col]).sum().loc[val,race])+" votes")
-    if (len(diff_counties)>0):
-        print()
-        print(diff_counties)
-        
-        
-def precinct_votes_check(merged_df,column_list,vest_on_left,name_col,print_level=0):
-    """Checks a merged dataframe with two election results at the precinct level
+    #Bounding box of each run in both shapes
+    xy = np.concatenate((left_xy[in_run], right_xy[in_run]))
+    run_id = np.concatenate((run_id, run_id))
+    low = np.full((run_id.max()+1, 2), np.inf)
+    high = np.full((run_id.max()+1, 2), -np.inf)
+    np.minimum.at(low, run_id, xy)
+    np.maximum.at(high, run_id, xy)
+    run_pair = np.zeros(run_id.max()+1, dtype=np.int64)
+    run_pair[run_id] = np.concatenate((ring_pair[ring_idx[in_run]],)*2)
+    run_area = np.prod(np.where(np.isfinite(high-low), high-low, 0), axis=1)
+    bounds[same] = (np.bincount(run_pair, weights=run_area, minlength=n)/10e6)[same]
+    return bounds
 
-    Args:
-      merged_df: DataFrame with one set of election results joined to another
-      column_list: List of races that there are votes for
-      vest_on_left: Boolean specifying whether VEST data is on the left side of merged_df
-      name_col: String of the column name to refer to precincts when a difference occurs
-      print_level: Integer that specifies how large the vote difference in a precinct must be to be printed
+#How compare_geometries resolved each pair, see screen_geometry_pairs
+GEOMETRY_SCREEN_TIERS = ["identical", "bounded", "exact"]
 
-    Returns:
-      Nothing, only prints out an analysis
-    """
-    merged_df = merged_df.sort_values(by=[name_col],inplace=False)
-    matching_rows = 0
-    different_rows = 0
-    diff_list=[]
-    diff_values = []
-    max_diff = 0
-    for index,row in merged_df.iterrows():
-        same = True
-        for i in column_list:
-            left_data = i + "_x"
-            right_data = i + "_y"
-            if ((row[left_data] is None) or (row[right_data] is None) or (np.isnan(row[right_data])or(np.isnan(row[left_data])))):
-                print("FIX NaN value at: ", row[name_col])
-                return;
-            diff = abs(row[left_data]-row[right_data])
-            if (diff>0):
-                same = False
-                diff_values.append(abs(diff))
-                if (diff>max_diff):
-                    max_diff = diff
-            if(diff>print_level):
-                if (vest_on_left):
-                    print(i, "{:.>72}".format(row[name_col]), "(V)","{:.>5}".format(int(row[left_data]))," (S){:.>5}".format(int(row[right_data])),"(D):{:>5}".format(int(row[left_data]-row[right_data])))                           
-                else:
-                    print(i, "{:.>72}".format(row[name_col]), "(S)","{:.>5}".format(int(row[left_data]))," (V){:.>5}".format(int(row[right_data])),"(D):{:>5}".format(int(row[left_data]-row[right_data])))
-        if(same != True):
-            different_rows +=1
-            diff_list.append(row[name_col])
-        else:
-            matching_rows +=1
-    print("")
-    print("There are ", len(merged_df.index)," total rows")
-    print(different_rows," of these rows have election result differences")
-    print(matching_rows," of these rows are the same")
-    print("")
-    print("The max difference between any one shared column in a row is: ", max_diff)
-    if(len(diff_values)!=0):
-        print("The average difference is: ", str(sum(diff_values)/len(diff_values)))
-    count_big_diff = len([i for i in diff_values if i > 10])
-    print("There are ", str(count_big_diff), "precinct results with a difference greater than 10")
-    print("")
-    print("All precincts containing differences:")
-    diff_list.sort()
-    print(diff_list)
-    
-    
-from matplotlib.lines import Line2D
+def screen_geometry_pairs(left_geoms, right_geoms, area_threshold):
+    '''Purpose: pre-screen two aligned arrays of geometries before the exact overlays of the geometry comparisons
+        identical: same geometry_fingerprints, the difference is 0 without any overlay
+        bounded: the changed_vertex_area_bounds bound is at most area_threshold (and smaller than the shape, so the two overlap),
+            the pair can't be flagged, but its difference is not measured
+        exact: everything else, left for the symmetric difference and intersection
+    Returns arrays of the tier, the area difference (0 for identical, NaN otherwise), the bound (NaN unless bounded)
+    and no_overlap (False unless identical)
+    '''
+
+    import shapely
+    tier = np.full(len(left_geoms), "exact", dtype=object)
+    area = np.full(len(left_geoms), np.nan)
+    bound = np.full(len(left_geoms), np.nan)
+    no_overlap = np.zeros(len(left_geoms), dtype=bool)
+    left_prints = geometry_fingerprints(left_geoms)
+    identical = (left_prints == geometry_fingerprints(right_geoms)) & (left_prints != None)
+    tier[identical] = "identical"
+    area[identical] = 0
+    no_overlap[identical] = shapely.is_empty(left_geoms[identical])
+    remaining = np.flatnonzero(~identical)
+    bounds = changed_vertex_area_bounds(left_geoms[remaining], right_geoms[remaining])
+    bounded = remaining[(bounds <= area_threshold) & (bounds < shapely.area(left_geoms[remaining])/10e6)]
+    tier[bounded] = "bounded"
+    bound[bounded] = bounds[np.isin(remaining, bounded)]
+    return tier, area, bound, no_overlap
 
-def compare_geometries(gdf_1,gdf_2,left_gdf_name,right_gdf_name,join_col_name,area_threshold=.1):
+def print_geometry_screen(tier):
+    '''Purpose: print how many pairs each GEOMETRY_SCREEN_TIERS tier of screen_geometry_pairs resolved
+    '''
+
+    counts = pd.Series(tier).value_counts().reindex(GEOMETRY_SCREEN_TIERS, fill_value=0)
+    print(str(counts["identical"])+" identical (same fingerprint), "+str(counts["bounded"])+" within the threshold (changed vertex bounds), "
+          +str(counts["exact"])+" compared with exact overlays")
+
+@instrumented
+def compare_geometries(gdf_1,gdf_2,left_gdf_name,right_gdf_name,join_col_name,area_threshold=.1,prescreen=False):
     '''
     Function that joins to GeoDataFrames on a column and reports area differences row-by-row.
     Should generally be used by grouping by the district assignments that we've made and comparing against an official map.
+    With prescreen, pairs with identical fingerprints skip the overlays (see screen_geometry_pairs), every other pair is measured
     '''
-    gdf_1 = gdf_1.to_crs(3857)
-    gdf_2 = gdf_2.to_crs(3857)
+    import geopandas as gp
+    from matplotlib.lines import Line2D
+    #Reprojected and repaired (buffer(0)) before the merge, so the geometry cache can skip both steps on unchanged inputs
+    gdf_1 = reproject_repair(gdf_1)
+    gdf_2 = reproject_repair(gdf_2)
     both = pd.merge(gdf_1,gdf_2,how="outer",on=join_col_name,validate="1:1",indicator=True)
     if(both["_merge"].str.contains("_")).any():
         print("Non-unique merge values")
         raise ValueError
     left_geoms = gp.GeoDataFrame(both,geometry="geometry_x")
     right_geoms = gp.GeoDataFrame(both,geometry="geometry_y")
-    left_geoms["geometry_x"]=left_geoms.buffer(0)
-    right_geoms["geometry_y"]=right_geoms.buffer(0)
     if (left_geoms.is_valid==False).any():
         raise ValueError
     elif(right_geoms.is_valid==False).any():
         raise ValueError
+    if prescreen:
+        tier, screened_area, _, _ = screen_geometry_pairs(np.asarray(left_geoms.geometry.values),np.asarray(right_geoms.geometry.values),area_threshold)
+        #Every bucket below is a measured difference, so bounded pairs still get the overlays here
+        tier[tier=="bounded"] = "exact"
+    else:
+        tier = np.full(both.shape[0],"exact",dtype=object)
     count = 0
     area_list = []
     print("Checking " + str(both.shape[0])+" districts for differences of greater than "+str(area_threshold)+" km^2")
     print()
     for index,row in both.iterrows():
+        if (tier[index]!="exact"):
+            area_list.append(screened_area[index])
+            continue
         diff = left_geoms.iloc[[index]].symmetric_difference(right_geoms.iloc[[index]])
         intersection = left_geoms.iloc[[index]].intersection(right_geoms.iloc[[index]])
         area = float(diff.area/10e6)
@@ -308,6 +2190,9 @@ def compare_geometries(gdf_1,gdf_2,left_gdf_name,right_gdf_name,join_col_name,ar
     print()
     print("Of the "+ str(both.shape[0])+" districts:")
     print()
+    if prescreen:
+        print_geometry_screen(tier)
+        print()
     print(str(len(df[df[0]==0]))+" districts w/ a difference of 0 km^2")
     print(str(len(df[(df[0]<.1) & (df[0]>0)]))+ " districts w/ a difference between 0 and 0.1 km^2")
     print(str(len(df[(df[0]<.5) & (df[0]>=.1)]))+ " districts w/ a difference between 0.1 and 0.5 km^2")
@@ -316,9 +2201,156 @@ def compare_geometries(gdf_1,gdf_2,left_gdf_name,right_gdf_name,join_col_name,ar
     print(str(len(df[(df[0]<5) & (df[0]>=2)]))+ " districts w/ a difference between 2 and 5 km^2")
     print(str(len(df[(df[0]>=5)]))+ " districts w/ a difference greater than 5 km^2")
 
+
+#Buckets (lower bound, upper bound, label) used to summarize compare_geometries area differences, in km^2
+AREA_DIFFERENCE_BUCKETS = [(0,0,"a difference of 0 km^2"),
+                           (0,.1,"a difference between 0 and 0.1 km^2"),
+                           (.1,.5,"a difference between 0.1 and 0.5 km^2"),
+                           (.5,1,"a difference between 0.5 and 1 km^2"),
+                           (1,2,"a difference between 1 and 2 km^2"),
+                           (2,5,"a difference between 2 and 5 km^2"),
+                           (5,np.inf,"a difference greater than 5 km^2")]
+
+def area_difference_bucket(areas):
+    '''Purpose: label each area difference with its AREA_DIFFERENCE_BUCKETS bucket
+    (0 is its own bucket, every other bucket includes its lower bound, NaN differences that weren't measured get no bucket)
+    '''
+
+    areas = np.asarray(areas,dtype=float)
+    conditions = [areas==0]+[(areas>=low)&(areas<high)&(areas>0) for low, high, label in AREA_DIFFERENCE_BUCKETS[1:-1]]+[areas>=AREA_DIFFERENCE_BUCKETS[-1][0]]
+    labels = [label for low, high, label in AREA_DIFFERENCE_BUCKETS]
+    return pd.Categorical(np.select(conditions,labels,default=None),categories=labels)
+
+@instrumented
+def geometry_area_differences(left_geoms,right_geoms):
+    '''Purpose: symmetric difference area (same units as compare_geometries) and whether the shapes share no area,
+    for two aligned arrays of shapely geometries. Module-level so it can be sent to worker processes.
+    '''
+
+    import shapely
+    area = shapely.area(shapely.symmetric_difference(left_geoms,right_geoms))/10e6
+    return area, ~shapely.intersects(left_geoms,right_geoms)
+
+@instrumented
+def compare_geometries_vectorized(gdf_1,gdf_2,join_col_name,area_threshold=.1,n_workers=None,chunk_size=5000,prescreen=True):
+    '''Purpose: vectorized version of compare_geometries, computes every area difference
+    with array-level geometry operations and returns the results instead of printing and plotting.
+    Use print_geometry_comparison and plot_geometry_differences to view the results.
+
+    Arguments:
+        gdf_1, gdf_2: GeoDataFrames to compare, ex: our district assignments dissolved by district, and the official map
+        join_col_name: column in both GeoDataFrames to join them on, must be unique in each
+        area_threshold: difference in km^2 above which a feature is flagged
+        n_workers: number of processes to split the comparison across, None to run in this process
+        chunk_size: number of features sent to a worker process at a time
+        prescreen: only run the overlays on the pairs that screen_geometry_pairs can't resolve (identical fingerprints,
+            or a changed vertex bound of at most area_threshold, which is kept as area_bound with area_diff left NaN)
+
+    Returns dictionary with:
+        areas: DataFrame indexed by join_col_name with area_diff, area_bound, no_overlap, over_threshold, bucket (NaN for bounded pairs)
+            and tier (see GEOMETRY_SCREEN_TIERS) columns
+        left, right: the reprojected and repaired geometries (GeoSeries indexed by join_col_name), used for plotting
+        area_threshold
+    '''
+
+    left = reproject_repair(gdf_1).set_index(join_col_name).geometry
+    right = reproject_repair(gdf_2).set_index(join_col_name).geometry
+    if not (left.index.is_unique and right.index.is_unique):
+        raise ValueError("Non-unique merge values")
+    if (len(left.index.symmetric_difference(right.index))!=0):
+        raise ValueError("Merge values not found in both GeoDataFrames: "+str(list(left.index.symmetric_difference(right.index))))
+    right = right.reindex(left.index)
+    if (~left.is_valid).any() or (~right.is_valid).any():
+        raise ValueError("Invalid geometries after buffer(0)")
+
+    def area_differences():
+        left_geoms = np.asarray(left.values)
+        right_geoms = np.asarray(right.values)
+        if prescreen:
+            tier, area, bound, no_overlap = screen_geometry_pairs(left_geoms,right_geoms,area_threshold)
+        else:
+            tier, area, bound, no_overlap = np.full(len(left_geoms),"exact",dtype=object), np.full(len(left_geoms),np.nan), np.full(len(left_geoms),np.nan), np.zeros(len(left_geoms),dtype=bool)
+        exact = np.flatnonzero(tier=="exact")
+        left_geoms = left_geoms[exact]
+        right_geoms = right_geoms[exact]
+        if (n_workers is None or n_workers<=1 or len(left_geoms)<=chunk_size):
+            area[exact], no_overlap[exact] = geometry_area_differences(left_geoms,right_geoms)
+        else:
+            starts = range(0,len(left_geoms),chunk_size)
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                results = list(executor.map(geometry_area_differences,
+                                            [left_geoms[i:i+chunk_size] for i in starts],
+                                            [right_geoms[i:i+chunk_size] for i in starts]))
+            area[exact] = np.concatenate([result[0] for result in results])
+            no_overlap[exact] = np.concatenate([result[1] for result in results])
+        return pd.DataFrame({"area_diff":area,"area_bound":bound,"no_overlap":no_overlap,"tier":tier},index=left.index)
+
+    #Keyed by the joined input geometries (and the screening, which depends on the threshold), so a cache hit skips the overlays too
+    differences = cached_geometry_step("screened_area_differences", area_differences,
+                                       gdf_1[[join_col_name, gdf_1.geometry.name]], gdf_2[[join_col_name, gdf_2.geometry.name]],
+                                       area_threshold if prescreen else None)
+    area = differences["area_diff"].to_numpy()
+    no_overlap = differences["no_overlap"].to_numpy()
+    areas = pd.DataFrame({"area_diff":area,
+                          "area_bound":differences["area_bound"].to_numpy(),
+                          "no_overlap":no_overlap,
+                          "over_threshold":area>area_threshold,
+                          "bucket":area_difference_bucket(area),
+                          "tier":pd.Categorical(differences["tier"],categories=GEOMETRY_SCREEN_TIERS)},index=left.index)
+    return {"areas":areas,"left":left,"right":right,"area_threshold":area_threshold}
+
+def print_geometry_comparison(comparison):
+    '''Purpose: print the results of compare_geometries_vectorized in the compare_geometries format
+    '''
+
+    areas = comparison["areas"]
+    print("Checking " + str(areas.shape[0])+" districts for differences of greater than "+str(comparison["area_threshold"])+" km^2")
+    print()
+    over_threshold = areas[areas["over_threshold"]]
+    for count, (name, area) in enumerate(over_threshold["area_diff"].items(),start=1):
+        print(str(count)+") For " + str(name) + " difference in area is " + str(area))
+    print()
+    print("Of the "+ str(areas.shape[0])+" districts:")
+    print()
+    for label, count in areas["bucket"].value_counts(sort=False).items():
+        print(str(count)+" districts w/ "+label)
+    if "area_bound" in areas.columns and areas["area_bound"].notna().any():
+        print(str(areas["area_bound"].notna().sum())+" districts w/ a difference below "+str(comparison["area_threshold"])+" km^2 (bounded by their changed vertices, not measured)")
+    if "tier" in areas.columns:
+        print()
+        print_geometry_screen(areas["tier"])
+
+def plot_geometry_differences(comparison,names,left_gdf_name,right_gdf_name):
+    '''Purpose: plot the two shapes and their overlap for only the requested features of a compare_geometries_vectorized result
+
+    Arguments:
+        comparison: dictionary returned by compare_geometries_vectorized
+        names: list of join_col_name values to plot, ex: list(comparison['areas'].query('over_threshold').index)
+        left_gdf_name, right_gdf_name: names for the legend
+    '''
+
+    from matplotlib.lines import Line2D
+    custom_lines = [Line2D([0], [0], color='green', lw=4),
+                    Line2D([0], [0], color='orange', lw=4),
+                    Line2D([0], [0], color='blue', lw=4)]
+    axes = []
+    for name in names:
+        left = comparison["left"].loc[[name]]
+        right = comparison["right"].loc[[name]]
+        base = left.plot(color="orange",figsize=(10,10))
+        right.plot(color="blue",ax=base)
+        if not (comparison["areas"].at[name,"no_overlap"]):
+            left.intersection(right).plot(color="green",ax=base)
+        base.set_title(name)
+        base.legend(custom_lines, ['Overlap', left_gdf_name,right_gdf_name])
+        axes.append(base)
+    return axes
+
 def field_name_length_check(gdf_col_list):
     
     '''Purpose: Check to ensure all fields fit within GIS 10 character limit
+    Returns the list of field names to change
     '''
     
     to_change = []
@@ -329,6 +2361,7 @@ def field_name_length_check(gdf_col_list):
         print('All field names within GIS 10 character limit.')
     else:
         print('Change the following field names:', to_change)
+    return to_change
 
 def select_cols(df, prefix):
     
@@ -354,17 +2387,109 @@ def format_erj_cols(location_desc_cols, election_columns, geo_col):
     col_formatted = location_desc_cols + election_columns + geo_col
     return col_formatted
 
+@instrumented
 def create_erj_shp(gdf, shp_name):
     
     '''Purpose: create directory (folder) to store ERJ shapefile and create file from gdf.
     In cases where separate election files, run once, then run "gdf.to_file()" 
     separately for each file going to the same directory.
+    Sparse vote columns (see to_sparse_votes) and categorical columns (see compact_dtypes) are converted here, at the write.
     '''
     
+    gdf = densify_votes(gdf)
     os.mkdir('./'+shp_name)
     gdf.to_file('./'+shp_name+'/'+shp_name+'.shp')
     print(shp_name, 'shapefile created.')
 
+#Files written for a shapefile by write_erj_files
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+#File extension and GDAL driver for each ERJ output format ('parquet' is written with pyarrow, not GDAL)
+ERJ_FILE_FORMATS = {'shp': ('.shp', 'ESRI Shapefile'),
+                    'fgb': ('.fgb', 'FlatGeobuf'),
+                    'parquet': ('.parquet', None)}
+
+def write_geoparquet(path, attributes_df, wkb, crs, geometry_types):
+    
+    '''Purpose: write a GeoParquet file from already WKB-encoded geometries (used by write_erj_files)
+    '''
+    
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(attributes_df, preserve_index=False)
+    table = table.append_column('geometry', pa.array(wkb, type=pa.binary()))
+    geo = {'version': '1.0.0', 'primary_column': 'geometry',
+           'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': geometry_types,
+                                    'crs': crs.to_json_dict() if crs is not None else None}}}
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'geo': json.dumps(geo).encode('utf-8')})
+    pq.write_table(table, path)
+
+@instrumented
+def write_erj_files(gdf, shp_name, election_files=None, location_desc_cols=['UNIQUE_ID', 'COUNTYFP'], formats=['shp'], spatial_index=False):
+    
+    '''Purpose: write the ERJ file(s) for gdf into the ./<shp_name> directory, in any of the ERJ_FILE_FORMATS.
+    The geometry is encoded once and shared by every election file and format.
+    Unlike create_erj_shp, an existing directory is reused (files with the same name are replaced).
+    
+    Arguments:
+        gdf: GeoDataFrame with the location, election and geometry columns
+        shp_name: name of the directory, ex: 'az_gen_20_prec'
+        election_files: file name: list of election columns, for separate election files in the same directory,
+            ex: {'az_gen_20_prec': pres_cols, 'az_gen_20_st_prec': state_cols}. None writes every column to <shp_name>
+        location_desc_cols: columns at the start of every file, ex: UNIQUE_ID, COUNTYFP, any other VEST cols
+        formats: list of 'shp', 'fgb' (FlatGeobuf) and/or 'parquet' (GeoParquet)
+        spatial_index: write the FlatGeobuf spatial index, which lets readers filter by bounding box but
+            makes GDAL sort the features along its Hilbert curve, so the .fgb rows are no longer in gdf's order
+    
+    Returns DataFrame with the file, format, rows, columns, MB, seconds and MB_per_second of every file written
+    '''
+    
+    import pyogrio.raw
+    import shapely
+    if election_files is None:
+        election_files = {shp_name: [col for col in gdf.columns if col not in location_desc_cols and col != gdf.geometry.name]}
+    if 'shp' in formats:
+        #Shapefile fields have to fit in the GIS 10 character limit
+        to_change = field_name_length_check(list(dict.fromkeys([col for cols in election_files.values() for col in location_desc_cols+cols])))
+        if to_change != []:
+            raise ValueError('Field names longer than 10 characters: '+str(to_change))
+    
+    os.makedirs('./'+shp_name, exist_ok=True)
+    wkb = shapely.to_wkb(gdf.geometry.to_numpy())
+    geometry_types = sorted(gdf.geometry.geom_type.dropna().unique())
+    if len(geometry_types)==1:
+        geometry_type = geometry_types[0]
+    elif set(geometry_types)=={'Polygon', 'MultiPolygon'}:
+        geometry_type = 'MultiPolygon'
+    else:
+        geometry_type = 'Unknown'
+    crs_wkt = gdf.crs.to_wkt() if gdf.crs is not None else None
+    
+    written = []
+    for file_name, election_columns in election_files.items():
+        attributes_df = densify_votes(pd.DataFrame(gdf[location_desc_cols+election_columns]))
+        for file_format in formats:
+            extension, driver = ERJ_FILE_FORMATS[file_format]
+            path = './'+shp_name+'/'+file_name+extension
+            start = time.perf_counter()
+            if driver is None:
+                write_geoparquet(path, attributes_df, wkb, gdf.crs, geometry_types)
+            else:
+                layer_options = {'SPATIAL_INDEX': 'YES' if spatial_index else 'NO'} if file_format=='fgb' else None
+                pyogrio.raw.write(path, wkb, [attributes_df[col].to_numpy() for col in attributes_df.columns], list(attributes_df.columns),
+                                  driver=driver, geometry_type=geometry_type, crs=crs_wkt, promote_to_multi=(geometry_type=='MultiPolygon'),
+                                  layer_options=layer_options)
+            seconds = time.perf_counter()-start
+            #A shapefile is several files, only its own parts are counted (not the other formats of the same file)
+            parts = SHAPEFILE_PARTS if file_format=='shp' else [extension]
+            size = sum(os.path.getsize('./'+shp_name+'/'+file_name+part) for part in parts if os.path.exists('./'+shp_name+'/'+file_name+part))
+            written.append([path, file_format, len(attributes_df.index), len(attributes_df.columns)+1, size/1e6, seconds])
+            print(path, 'created.')
+    
+    report = pd.DataFrame(written, columns=['file', 'format', 'rows', 'columns', 'MB', 'seconds'])
+    report['MB_per_second'] = report['MB']/report['seconds']
+    return report
+
 '''PH additions below
 Notes + suggestions from LF:
 - Add descriptions of arguments to remaining functions
@@ -373,6 +2498,7 @@ Notes + suggestions from LF:
 Like I said on the call, additions are a little more tedious now, but will made our documentation extra clear and adaptable for anyone else to use, and easy to show new team members if anyone new joins and needs to be oriented on the project or archived project (if far in the future)
 '''
 
+@instrumented
 def allocate_absentee(df_receiving_votes,df_allocating,column_list,col_allocating,allocating_to_all_empty_precs=False):
     """Allocates votes proportionally to precincts, usually by share of precinct-reported vote
 
@@ -434,6 +2560,7 @@ def allocate_absentee(df_receiving_votes,df_allocating,column_list,col_allocatin
                             precinct_specific_totals.loc[index,"Total_Votes"]=1
                             col_val = row[col_allocating]
                             df_receiving_votes.loc[df_receiving_votes[col_allocating]==col_val,"Total_Votes"]=1
+    count_fallback("special_allocation", len(special_allocation_needed))
 
     #Create some new columns for each of these races to deal with the allocation
     for race in column_list:
@@ -514,6 +2641,143 @@ def allocate_absentee(df_receiving_votes,df_allocating,column_list,col_allocatin
 
     return df_receiving_votes
 
+@instrumented
+def allocate_absentee_vectorized(df_receiving_votes,df_allocating,column_list,col_allocating,allocating_to_all_empty_precs=False):
+    """Allocates votes proportionally to precincts, computing every race in every county at once
+
+    Gives the same vote totals as allocate_absentee, but the shares, floors, remainders and the
+    largest-remainder rounding are done on (precinct x race) arrays instead of row by row
+
+    Args:
+      df_receiving_votes: DataFrame with precinct-level votes
+      df_allocating: DataFrame with the votes to allocate
+      column_list: List of races that votes are being allocated for
+      col_allocating: String referring to what level the allocation occurs at (most often county)
+      allocating_to_all_empty_precs: Boolean for special case where all votes in df_receiving_votes are 0
+
+    Returns:
+      A tuple of the precinct-level votes dataframe (df_receiving_votes) with the allocated votes and
+      a DataFrame of the "special allocation needed" cases, one row per county and race, with columns:
+        col_allocating, race, to_allocate: the votes that had to be allocated by total votes instead
+        empty_county: True if no precinct in the county had any votes, so every precinct was given a Total_Votes of 1
+    """
+
+    #Fill any n/a values with 0 (categorical columns from compact_dtypes are left as they are, 0 isn't one of their categories)
+    df_receiving_votes = df_receiving_votes.fillna({col: 0 for col, dtype in df_receiving_votes.dtypes.items() if not isinstance(dtype, pd.CategoricalDtype)})
+    #Only the nonzero votes are read (sparse columns from their stored values), a precinct without votes in a race gets none of its allocation
+    vote_rows, vote_cols, vote_values = nonzero_votes(df_receiving_votes, column_list)
+    vote_values = vote_values.astype(float)
+
+    #Add in the "Total Votes" for every precinct
+    if (allocating_to_all_empty_precs):
+        total_votes = np.ones(len(df_receiving_votes))
+    else:
+        total_votes = np.bincount(vote_rows, weights=vote_values, minlength=len(df_receiving_votes))
+
+    #County-level totals, rows in groupby (sorted) order, and the county of every precinct as a row number into them
+    totals_df = df_receiving_votes[[col_allocating]+column_list].copy()
+    totals_df["Total_Votes"] = total_votes
+    precinct_specific_totals = grouped_vote_totals(totals_df, column_list+["Total_Votes"], [col_allocating])
+    counties = precinct_specific_totals.index
+    county_idx = counties.get_indexer(df_receiving_votes[col_allocating])
+    allocating_totals = grouped_vote_totals(df_allocating, column_list, [col_allocating])
+    to_dole_out_totals = allocating_totals.reindex(counties)
+
+    prec_race_totals = precinct_specific_totals[column_list].to_numpy(dtype=float)
+    prec_total_votes = precinct_specific_totals["Total_Votes"].to_numpy(dtype=float)
+    has_allocation = counties.isin(df_allocating[col_allocating])
+    numer = to_dole_out_totals.to_numpy(dtype=float)
+    numer[~has_allocation] = 0
+    to_allocate = np.trunc(numer)
+
+    #Check the allocating to empty precincts code
+    if (allocating_to_all_empty_precs and (prec_race_totals != 0).any()):
+        print("Allocating to all empty precincts parameter incorrect")
+
+    #Races with votes to allocate in a county where none of its precincts had votes for that race get allocated by total votes
+    special = (prec_race_totals == 0) & (to_allocate != 0) & has_allocation[:,None]
+    empty_county = special.any(axis=1) & (prec_total_votes == 0)
+    prec_total_votes[empty_county] = 1
+    total_votes[empty_county[county_idx]] = 1
+    special_rows, special_cols = np.nonzero(special)
+    special_allocation = pd.DataFrame({col_allocating:counties[special_rows],
+                                       "race":np.array(column_list,dtype=object)[special_cols],
+                                       "to_allocate":to_allocate[special_rows,special_cols].astype(int),
+                                       "empty_county":empty_county[special_rows]})
+    count_fallback("special_allocation", len(special_allocation.index))
+
+    #The (precinct, race) pairs that can get votes: the nonzero votes, and every precinct of a county and race allocated by total votes
+    vote_county = county_idx[vote_rows]
+    by_votes = ~special[vote_county, vote_cols]
+    county_precincts = np.argsort(county_idx, kind="stable")
+    county_start = np.concatenate(([0], np.cumsum(np.bincount(county_idx, minlength=len(counties)))))
+    special_precincts = [county_precincts[county_start[county]:county_start[county+1]] for county in special_rows]
+    rows = np.concatenate([vote_rows[by_votes]]+special_precincts)
+    cols = np.concatenate([vote_cols[by_votes]]+[np.full(len(precincts), col) for precincts, col in zip(special_precincts, special_cols)])
+    val = np.concatenate([vote_values[by_votes]]+[total_votes[precincts] for precincts in special_precincts])
+    county = county_idx[rows]
+    denom = np.where(special[county, cols], prec_total_votes[county], prec_race_totals[county, cols])
+
+    #First pass: the vote share of every pair, and its floor and remainder
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vote_share = np.where(denom == 0, 0.0, (val/denom)*numer[county, cols])
+    vote_share[~has_allocation[county]] = 0
+    remainders = vote_share % 1
+    floors = np.floor(vote_share)
+
+    #How many votes still need to be allocated in each county for each race, because we took the floor of all the initial allocations
+    group = county*len(column_list)+cols
+    floor_totals = np.bincount(group, weights=floors, minlength=len(counties)*len(column_list)).reshape(len(counties), len(column_list))
+    to_go = np.round(to_allocate - floor_totals)
+    to_go[~has_allocation] = 0
+
+    #Second pass: rank the remainders within each county and race, largest first and ties in row order (as nlargest does),
+    #then round up the top to_go pairs. Pairs without a remainder (including the pairs left out) rank last and rounding
+    #them up changes nothing, so only the others are ranked
+    ranked = np.flatnonzero(remainders > 0)
+    order = ranked[np.lexsort((rows[ranked], -remainders[ranked], group[ranked]))]
+    sorted_group = group[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_group, sorted_group, side="left")
+    round_up = np.zeros(len(rows), dtype=bool)
+    round_up[order] = rank < to_go[county[order], cols[order]]
+    allocated = np.where(round_up, np.ceil(vote_share), floors)
+
+    #Compact (unsigned) vote columns stay compact, only widened if the allocated votes no longer fit, and sparse columns stay sparse
+    #(rebuilt one column at a time, like widen_field_totals)
+    if not any(is_sparse_vote_column(df_receiving_votes[race]) for race in column_list):
+        #Every (precinct, race) pair is in rows and cols once
+        allocated_votes = df_receiving_votes[column_list].to_numpy(dtype=float)
+        allocated_votes[rows, cols] += allocated
+        allocated_columns = [allocated_votes[:,j] for j in range(len(column_list))]
+    else:
+        col_order = np.argsort(cols, kind="stable")
+        col_starts = np.searchsorted(cols[col_order], np.arange(len(column_list)+1))
+        allocated_columns = []
+        for j, race in enumerate(column_list):
+            column = df_receiving_votes[race]
+            values = column.sparse.to_dense().to_numpy(dtype=float) if is_sparse_vote_column(column) else column.to_numpy(dtype=float)
+            values[rows[col_order[col_starts[j]:col_starts[j+1]]]] += allocated[col_order[col_starts[j]:col_starts[j+1]]]
+            allocated_columns.append(values)
+    vote_dtypes = []
+    for j, dtype in enumerate(df_receiving_votes[column_list].dtypes):
+        subtype = dtype.subtype if isinstance(dtype, pd.SparseDtype) else dtype
+        new_dtype = np.result_type(subtype, smallest_vote_dtype(allocated_columns[j])) if subtype.kind == 'u' else np.dtype(int)
+        vote_dtypes.append(pd.SparseDtype(new_dtype, 0) if isinstance(dtype, pd.SparseDtype) else new_dtype)
+    if all(not isinstance(dtype, pd.SparseDtype) and dtype == np.dtype(int) for dtype in vote_dtypes):
+        df_receiving_votes[column_list] = allocated_votes.astype(int)
+    else:
+        df_receiving_votes[column_list] = pd.DataFrame({race: pd.arrays.SparseArray(allocated_columns[j].astype(vote_dtypes[j].subtype), fill_value=0)
+                                                        if isinstance(vote_dtypes[j], pd.SparseDtype) else allocated_columns[j].astype(vote_dtypes[j])
+                                                        for j, race in enumerate(column_list)}, index=df_receiving_votes.index)
+
+    #Check to make sure all the votes have been allocated
+    expected = prec_race_totals.sum(axis=0) + allocating_totals.sum().to_numpy(dtype=float)
+    for j, race in enumerate(column_list):
+        if (int(expected[j]) != df_receiving_votes[race].sum()):
+            print("Some issue in allocating votes for:", race)
+
+    return df_receiving_votes, special_allocation
+
 # Note: The below are all used together to deal with the precinct splits
     
 def is_split_precinct(district_assignment_list):
@@ -611,13 +2875,117 @@ def get_name(contest):
         return likely_last[0:3]
     
 
-for contest in pivoted_2020.columns:
-    if contest not in keep_names and "Amendment" not in contest and "Carlos G. Mu" not in contest and "President" not in contest:
-        # Add in a condition about the 20
-        value = "G"+ get_race(contest)+ get_party(contest)+ get_name(contest)
-        contest_name_change_dict[contest] = value
+#Contest header parsers by state - state: dictionary of the 'race', 'party' and 'name' functions, each taking one contest header
+#Above functions follow the Florida convention, ex: 'State Senator District 9 - Jason Brodeur PARTY:REP'
+CONTEST_HEADER_PARSERS = {'FL': {'race': get_race, 'party': get_party, 'name': get_name}}
+
+def register_contest_header_parser(state, race=get_race, party=get_party, name=get_name):
+    
+    '''Purpose: add or replace the contest header parsers for a state (defaults are the Florida parsers above)
+    '''
+    
+    CONTEST_HEADER_PARSERS[state] = {'race': race, 'party': party, 'name': name}
+    parse_contest_header.cache_clear()
+
+@lru_cache(maxsize=None)
+def parse_contest_header(contest, state='FL'):
+    
+    '''Purpose: (race, party, name) for a contest header with the state's registered parsers,
+    memoized so each unique header is only parsed once
+    '''
+    
+    parsers = CONTEST_HEADER_PARSERS[state]
+    return parsers['race'](contest), parsers['party'](contest), parsers['name'](contest)
+
+#Memoized get_level_dist, for parsing the same district contest headers many times
+parse_level_dist = lru_cache(maxsize=None)(get_level_dist)
+
+def contest_header_field_names(columns, keep_names, election_type='G', state='FL', skip_strs=['Amendment', 'President']):
+    
+    '''Purpose: RDH field name for every contest header of a pivoted results table in one call
+    Arguments:
+        columns: list of headers, ex: pivoted_2020.columns
+        keep_names: non-contest columns to leave as is, ex: ['pct_std', 'County Name']
+        election_type: ex 'G'
+        state: which registered parsers to use, see CONTEST_HEADER_PARSERS
+        skip_strs: headers containing any of these are left to be named by hand
+    Returns dictionary of header: field name, and the list of skipped contest headers
+    '''
+    
+    contest_name_change_dict = {}
+    skipped = []
+    for contest in columns:
+        if contest in keep_names:
+            continue
+        if any(skip_str in contest for skip_str in skip_strs):
+            skipped.append(contest)
+        else:
+            race, party, name = parse_contest_header(contest, state)
+            contest_name_change_dict[contest] = election_type + race + party + name
+    return contest_name_change_dict, skipped
+
+'''contest_header_field_names() ex:
+contest_name_change_dict, skipped = contest_header_field_names(pivoted_2020.columns, keep_names, skip_strs=["Amendment", "Carlos G. Mu", "President"])
+for contest in skipped:
+    print("'"+contest+"':'',")
+'''
+
+@instrumented
+def find_split_precincts(pivoted_df, precinct_col, district_cols=None):
+
+    '''Purpose: vectorized version of the get_level_dist() example loop - find the precincts
+    with votes in more than one district of the same level (CON, SU or SL)
+    Arguments:
+        pivoted_df: pivoted election results, one row per precinct and one column per contest header
+        precinct_col: precinct identifier column, ex: 'pct_std'
+        district_cols: district contest headers, defaults to every header with "Representative" or "State Senator"
+    Each header is parsed once into (level, district), the votes are turned into a (precinct x level-district)
+    non-zero indicator matrix, and splits are found by counting the districts per level in each row
+    Returns split_precincts_list ({precinct: {level: [districts]}} for split precincts only, like is_split_precinct)
+    and precinct_mapping_dict ({precinct: [(level, district), ...]} for every precinct), both in the loop's order
+    '''
+
+    if district_cols is None:
+        district_cols = [i for i in pivoted_df.columns if "Representative" in i or "State Senator" in i]
+    col_info = [parse_level_dist(contest) for contest in district_cols]
+    level_dists = list(dict.fromkeys(col_info))
+    col_pair = np.array([level_dists.index(info) for info in col_info], dtype=int)
+
+    #Non-zero indicator and, per level-district, the first column (in district_cols order) with votes
+    rows, cols, _ = nonzero_votes(pivoted_df, district_cols)
+    nonzero = np.zeros((len(pivoted_df.index), len(district_cols)), dtype=bool)
+    nonzero[rows, cols] = True
+    first_col = np.where(nonzero, np.arange(len(district_cols)), len(district_cols))
+    by_pair = np.argsort(col_pair, kind='stable')
+    pair_starts = np.searchsorted(col_pair[by_pair], np.arange(len(level_dists)))
+    if len(district_cols)==0:
+        first_pair_col = np.zeros((len(pivoted_df.index), 0), dtype=int)
     else:
-        print("'"+contest+"':'',")
+        first_pair_col = np.minimum.reduceat(first_col[:, by_pair], pair_starts, axis=1)
+    has_pair = first_pair_col < len(district_cols)
+
+    #Split precincts: more than one district with votes in any level
+    pair_level = np.array([level for level, dist in level_dists], dtype=object)
+    is_split = np.zeros(len(pivoted_df.index), dtype=bool)
+    for level in dict.fromkeys(pair_level):
+        is_split |= has_pair[:, pair_level==level].sum(axis=1) > 1
+
+    #Build the dictionaries from the non-zero entries, ordered by the first column with votes in each row
+    rows, pairs = np.nonzero(has_pair)
+    order = np.lexsort((first_pair_col[rows, pairs], rows))
+    rows, pairs = rows[order], pairs[order]
+    precincts = pivoted_df[precinct_col].to_numpy()
+    precinct_mapping_dict = {precinct: [] for precinct in precincts}
+    for row, pair in zip(rows, pairs):
+        precinct_mapping_dict[precincts[row]].append(level_dists[pair])
+    split_precincts_list = {}
+    for row in np.nonzero(is_split)[0]:
+        precinct_list = precinct_mapping_dict[precincts[row]]
+        levels = {}
+        for level, dist in precinct_list:
+            levels.setdefault(level, []).append(dist)
+        split_precincts_list[precincts[row]] = {level: dists for level, dists in levels.items() if len(dists) > 1}
+    return split_precincts_list, precinct_mapping_dict
 
 
 def return_cong_splits(split_dict):
@@ -626,13 +2994,16 @@ def return_cong_splits(split_dict):
             return split_dict['CON']
         
 
+@instrumented
 def district_splits(cd_list, level, old_name, elections_gdf, shps_gdf, unique_ID_col, district_ID, races_list):
+    import geopandas as gp
     full_shape = elections_gdf.loc[elections_gdf[unique_ID_col]==old_name]
     for index in range(0,len(cd_list)):
         district = shps_gdf.loc[shps_gdf[district_ID]==cd_list[index]]
         new_prec = gp.overlay(full_shape, district, how='intersection',keep_geom_type=True)
         if(new_prec.empty):
             print("***Issue merging District: ",cd_list[index],"and prec:",old_name,"***")
+            count_fallback("empty_intersection")
             print(full_shape)
             ax = full_shape.boundary.plot(figsize=(20,20))
         new_prec = new_prec[list(elections_gdf.columns)]
@@ -664,3 +3035,339 @@ for val in join_attempt_two["UNIQUE_ID"]:
         print(val, "=>", cong_splits_dict[val])
         join_attempt_two = district_splits(cong_splits_dict[val],"CON",val, join_attempt_two, fl_cong_shapefile, "pct_std", "CD116FP", state_data_columns)
 '''
+
+
+@instrumented
+def district_splits_batch(splits_dict, elections_gdf, shps_gdfs, unique_ID_col, district_IDs, races_list):
+    '''Purpose: batch version of district_splits - split every precinct in splits_dict at once,
+    with one overlay per level of all the affected precincts against that level's districts
+
+    Arguments:
+        splits_dict: level ('CON', 'SU' or 'SL') to a dictionary of precinct unique ID: list of its districts
+            ex: {'CON': cong_splits_dict}
+        elections_gdf: election results GeoDataFrame with the precincts to split
+        shps_gdfs: level to the district GeoDataFrame, ex: {'CON': fl_cong_shapefile}
+        unique_ID_col: unique precinct ID column in elections_gdf, ex: 'pct_std'
+        district_IDs: level to the district ID column in that level's GeoDataFrame, ex: {'CON': 'CD116FP'}
+        races_list: vote columns - in each piece, the ones without the piece's district in their name are set to 0
+
+    Levels are split in the order given, so a precinct can be split at more than one level
+    (the pieces from an earlier level are split again, still looked up by the original unique ID)
+
+    Returns:
+        elections_gdf with every split precinct replaced by its pieces, named "<unique ID>-(<level>-<district>)",
+        and a DataFrame of unique_ID_col, level, district for every precinct-district pair with no intersection
+    '''
+    import geopandas as gp
+
+    columns = list(elections_gdf.columns)
+    elections_gdf = elections_gdf.reset_index(drop=True)
+    original_ids = elections_gdf[unique_ID_col]
+    empty_intersections = []
+    for level, level_splits in splits_dict.items():
+        pairs = pd.DataFrame([(prec, dist) for prec, dists in level_splits.items() for dist in dists],
+                             columns=["_split_original_id","_split_district"])
+        if (len(pairs.index)==0):
+            continue
+        pairs["_split_order"] = range(len(pairs.index))
+
+        affected_mask = original_ids.isin(pairs["_split_original_id"]).to_numpy()
+        affected = elections_gdf[affected_mask].copy()
+        affected["_split_original_id"] = original_ids[affected_mask].to_numpy()
+        shps_gdf = shps_gdfs[level]
+        shps_gdf = shps_gdf[shps_gdf[district_IDs[level]].isin(pairs["_split_district"])]
+        districts = gp.GeoDataFrame({"_split_district":shps_gdf[district_IDs[level]].to_numpy()},geometry=shps_gdf.geometry.to_numpy(),crs=shps_gdf.crs)
+
+        #One overlay for the level, then keep only the precinct-district pairs that were asked for, in the order given
+        pieces = cached_geometry_step("overlay", lambda: gp.overlay(affected, districts, how='intersection',keep_geom_type=True), affected, districts)
+        pieces = pieces.merge(pairs, on=["_split_original_id","_split_district"], how="inner").sort_values("_split_order",kind="stable")
+        found = pairs.set_index(["_split_original_id","_split_district"]).index.isin(pieces.set_index(["_split_original_id","_split_district"]).index)
+        for prec, dist in pairs.loc[~found,["_split_original_id","_split_district"]].itertuples(index=False):
+            empty_intersections.append([prec, level, dist])
+        count_fallback("empty_intersection", (~found).sum())
+
+        #Zero out the race columns of other districts, one district at a time across all of its pieces
+        race_cols = [column for column in columns if column in races_list]
+        for dist in pieces["_split_district"].unique():
+            pieces.loc[pieces["_split_district"]==dist,[column for column in race_cols if dist not in column]] = 0
+        pieces[unique_ID_col] = pieces[unique_ID_col]+"-("+level+"-"+pieces["_split_district"]+")"
+
+        #Remove the precincts that were split and add all of the pieces at once
+        elections_gdf = pd.concat([elections_gdf[~affected_mask], pieces[columns]], ignore_index=True)
+        original_ids = pd.concat([original_ids[~affected_mask], pieces["_split_original_id"]], ignore_index=True)
+
+    return elections_gdf, pd.DataFrame(empty_intersections, columns=[unique_ID_col,"level","district"])
+
+
+#ERJ file validation (moved from ERJ_file_validater.ipynb)
+
+#District assignment column: how that level is referred to in the vote column names
+LEVEL_RACE_NAME_DICT = {"CONG_DIST":"CON",
+                        "SLDL_DIST":"SL",
+                        "SLDU_DIST":"SU"}
+
+@instrumented
+def district_assignment_errors(election_results_df, level, id_col="UNIQUE_ID"):
+    '''Purpose: check that the votes in each precinct match its district assignment,
+    ex: a precinct with CONG_DIST 04 should only have CON votes in the GCON04... columns
+    Note: As written, this will only work for fully numeric district assignments
+
+    Each column's district is parsed once from its name, then every non-zero vote (see nonzero_votes, sparse
+    columns are never densified) is checked at once against the district assigned to its precinct
+
+    Arguments:
+        election_results_df: ERJ file
+        level: district assignment column, one of LEVEL_RACE_NAME_DICT
+        id_col: precinct identifier to report errors with
+    Returns DataFrame with one row per error: id_col, level (the district assignment), column, column_district, votes
+    '''
+
+    finding = LEVEL_RACE_NAME_DICT[level]
+    pattern = re.compile(finding+r'\d*')
+    vote_cols = []
+    col_districts = []
+    for val in election_results_df.columns:
+        # Skip the assignment columns and columns where "CON", "SL", or "SU" is found in a name (more than 5 characters into the col name)
+        if isinstance(val, str) and finding in val and val not in LEVEL_RACE_NAME_DICT and val.find(finding) < 5:
+            vote_cols.append(val)
+            # The len(finding) part is needed here as sometimes there is more than one digit to the district
+            col_districts.append(pattern.search(val).group(0)[len(finding):])
+    ids = election_results_df[id_col].to_numpy() if id_col in election_results_df.columns else election_results_df.index.to_numpy()
+    assignment = election_results_df[level].to_numpy(dtype=object)
+
+    # Compare district codes as integers instead of comparing strings cell by cell
+    codes, districts = pd.factorize(pd.Series(list(assignment)+col_districts, dtype=object))
+    assignment_codes = codes[:len(assignment)]
+    col_codes = codes[len(assignment):]
+    rows, cols, votes = nonzero_votes(election_results_df, vote_cols)
+    errors = assignment_codes[rows] != col_codes[cols]
+    rows, cols = rows[errors], cols[errors]
+    return pd.DataFrame({id_col: ids[rows],
+                         level: assignment[rows],
+                         "column": np.array(vote_cols, dtype=object)[cols],
+                         "column_district": np.array(col_districts, dtype=object)[cols],
+                         "votes": votes[errors]})
+
+@instrumented
+def run_validation(election_results_df):
+    '''Purpose: validate a handful of things in a given ERJ file:
+    1) Whether the values in the "UNIQUE_ID" column are indeed unique
+    2) That there is a "COUNTYFP" column
+    3) That "UNIQUE_ID" and "COUNTYFP" are in the right order within the columns
+    4) That the actual votes assigned in cases of districts match the stated district assignments.
+        In other words, if we say a precinct is in CONG_DIST 4, does it only receive votes in CONG_DIST 4
+        This calls district_assignment_errors for every assignment column in the file
+
+    Returns a list of the problems found (empty if the file passes), each a dictionary with the 'check' and a 'message',
+    plus the duplicated 'ids' for UNIQUE_ID, or the district_assignment_errors row for a bad district assignment
+    '''
+
+    violations = []
+    columns = list(election_results_df.columns)
+
+    # Confirm that UNIQUE_ID column is unique
+    if "UNIQUE_ID" not in columns:
+        violations.append({"check": "UNIQUE_ID", "message": "No 'UNIQUE_ID' column"})
+    else:
+        duplicated = election_results_df["UNIQUE_ID"].duplicated(keep=False)
+        if duplicated.any():
+            violations.append({"check": "UNIQUE_ID", "message": "Non-unique UNIQUE_ID",
+                               "ids": list(election_results_df.loc[duplicated, "UNIQUE_ID"].unique())})
+
+    # Confirm that COUNTYFP column has been added
+    if "COUNTYFP" not in columns:
+        violations.append({"check": "COUNTYFP", "message": "No 'COUNTYFP' column"})
+
+    # Check order of columns
+    if columns[:2] != ["UNIQUE_ID", "COUNTYFP"]:
+        violations.append({"check": "column_order", "message": "Incorrect column placement"})
+
+    # Confirm that stated district assignment, matches actual district assignment
+    for level in LEVEL_RACE_NAME_DICT:
+        if level in columns:
+            for error in district_assignment_errors(election_results_df, level).to_dict("records"):
+                error["district_assignment"] = error.pop(level)
+                violations.append({"check": level, "message": "Bad "+level+" assignment", **error})
+
+    return violations
+
+def print_validation(violations):
+    '''Purpose: print the list of problems returned by run_validation
+    '''
+
+    if len(violations) == 0:
+        print("CONFIRMED: UNIQUE_ID is unique, COUNTYFP column added and in the right position, votes match the district assignments")
+        return
+    print("***ERROR SPOTTED***")
+    for violation in violations:
+        details = {key: value for key, value in violation.items() if key not in ["check", "message"]}
+        print(violation["message"], details if details else "")
+
+@instrumented
+def read_erj_attributes(file_path, columns=None):
+    '''Purpose: read only the attribute table (the .dbf) of an ERJ file, without parsing any geometry.
+    Use for the validation and the vote totals checks, which never look at the shapes.
+    Arguments:
+        file_path: path to the .shp (or any other file geopandas can read)
+        columns: list of columns to read, None for all of them,
+            ex: column_list+['COUNTYFP'] for county_totals_check(partner_df, source_df, column_list, 'COUNTYFP')
+    Returns a pandas DataFrame, see read_erj_geometry to add the shapes later if a geometric check needs them
+    '''
+
+    try:
+        import pyogrio
+    except ImportError:
+        count_fallback("geopandas_reader")
+        import geopandas as gp
+        fields = {} if columns is None else {"include_fields": columns}
+        return pd.DataFrame(gp.read_file(file_path, ignore_geometry=True, **fields))
+    return pyogrio.read_dataframe(file_path, columns=columns, read_geometry=False)
+
+@instrumented
+def read_erj_geometry(file_path, attributes_df=None):
+    '''Purpose: read only the shapes of an ERJ file, for when a geometric check like compare_geometries needs them
+    Arguments:
+        file_path: path to the .shp
+        attributes_df: DataFrame from read_erj_attributes for the same file (in file order) to add the shapes to
+    Returns a GeoDataFrame with the attributes_df columns (if given) and the geometry
+    '''
+
+    import geopandas as gp
+    try:
+        import pyogrio
+        shapes = pyogrio.read_dataframe(file_path, columns=[])
+    except ImportError:
+        count_fallback("geopandas_reader")
+        shapes = gp.read_file(file_path, include_fields=[])
+    if attributes_df is None:
+        return shapes
+    if len(attributes_df.index) != len(shapes.index):
+        raise ValueError("attributes_df does not have one row per shape in "+file_path)
+    return gp.GeoDataFrame(attributes_df.copy(), geometry=shapes.geometry.to_numpy(), crs=shapes.crs)
+
+@instrumented
+def validate_shapefile(file_path, attributes_only=True):
+    '''Purpose: run_validation on one ERJ shapefile, timed, for the batch runner (module-level so it can run in a worker process)
+    run_validation only needs the attributes, so by default the shapes are not read (attributes_only=False reads the full file)
+    Returns dictionary with the file, rows, seconds, violations, and error (the exception text if the file could not be read)
+    '''
+
+    start = time.perf_counter()
+    result = {"file": file_path, "rows": None, "seconds": None, "violations": [], "error": None}
+    try:
+        if attributes_only:
+            file_load = read_erj_attributes(file_path)
+        else:
+            import geopandas as gp
+            file_load = gp.read_file(file_path)
+        result["rows"] = len(file_load.index)
+        result["violations"] = run_validation(file_load)
+    except Exception as e:
+        result["error"] = repr(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def find_erj_files(root):
+    '''Purpose: every .shp file in every directory under root (ex: one directory per state/election, like "az_gen_20_prec")
+    '''
+
+    erj_files = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        erj_files += [os.path.join(dir_path, file_name) for file_name in sorted(file_names) if file_name.endswith(".shp")]
+    return erj_files
+
+@instrumented
+def validate_directories(root, max_workers=4, report_path=None):
+    '''Purpose: validate every ERJ shapefile under root across a pool of at most max_workers processes
+    Arguments:
+        root: directory holding the ERJ directories, only local files are read
+        max_workers: number of worker processes, 1 to validate in this process
+        report_path: if given, write the full results to <report_path>.json and a one row per file summary to <report_path>.csv
+    Returns list of validate_shapefile results, in file order
+    '''
+
+    erj_files = find_erj_files(root)
+    if max_workers <= 1 or len(erj_files) <= 1:
+        results = [validate_shapefile(file_path) for file_path in erj_files]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(validate_shapefile, erj_files))
+    if report_path is not None:
+        with open(report_path+".json", "w") as report_file:
+            json.dump(results, report_file, indent=1, default=str)
+        summary = pd.DataFrame({"directory": [os.path.dirname(result["file"]) for result in results],
+                                "file": [os.path.basename(result["file"]) for result in results],
+                                "rows": [result["rows"] for result in results],
+                                "violations": [len(result["violations"]) for result in results],
+                                "passed": [result["error"] is None and len(result["violations"]) == 0 for result in results],
+                                "seconds": [result["seconds"] for result in results],
+                                "error": [result["error"] for result in results]})
+        summary.to_csv(report_path+".csv", index=False)
+    return results
+
+#Seconds that importing erj_toolbox may add on top of importing pandas and numpy, which the core checks need
+IMPORT_TIME_BUDGET = 0.05
+#Modules that should only be loaded by the functions that use them, never by importing the toolbox
+LAZY_MODULES = ['geopandas', 'shapely', 'matplotlib', 'pyogrio', 'fiona']
+
+def measure_import_time(repeat=5, budget=IMPORT_TIME_BUDGET):
+    '''Purpose: measure the cost of importing erj_toolbox in a fresh interpreter, as a short-lived batch worker pays it
+    Arguments:
+        repeat: number of fresh interpreters to time, the fastest is reported
+        budget: seconds allowed on top of importing pandas and numpy
+    Returns dictionary with the toolbox seconds (on top of pandas/numpy), dependency_seconds (pandas/numpy),
+    eager_modules (any LAZY_MODULES loaded by the import) and within_budget
+    '''
+
+    import subprocess
+    code = ("import sys, time; start = time.perf_counter(); import pandas, numpy; middle = time.perf_counter(); "
+            "import erj_toolbox; end = time.perf_counter(); "
+            "print(middle-start, end-middle); print(','.join(m for m in "+repr(LAZY_MODULES)+" if m in sys.modules))")
+    timings = []
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.splitlines()
+        dependency_seconds, seconds = [float(t) for t in output[0].split()]
+        eager_modules = [m for m in output[1].split(",") if m] if len(output) > 1 else []
+        timings.append((seconds, dependency_seconds))
+    seconds, dependency_seconds = min(timings)
+    result = {"seconds": seconds, "dependency_seconds": dependency_seconds, "eager_modules": eager_modules,
+              "within_budget": seconds <= budget and len(eager_modules) == 0}
+    print("Importing erj_toolbox: "+"{:.3f}".format(seconds)+" s on top of "+"{:.3f}".format(dependency_seconds)+" s for pandas/numpy (budget "+str(budget)+" s)")
+    if eager_modules:
+        print("Loaded on import, should be lazy:", eager_modules)
+    return result
+
+def main(argv=None):
+    '''Purpose: command line batch validation, ex: python erj_toolbox.py ./erj_files --workers 8 --report validation_report
+    Exit status is 1 if no ERJ shapefile is found under root, or if any file fails a check or cannot be read
+    '''
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Validate every ERJ shapefile in the directories under root")
+    parser.add_argument("root", help="directory holding the ERJ directories (ex: az_gen_20_prec/)")
+    parser.add_argument("--workers", type=int, default=4, help="maximum number of worker processes")
+    parser.add_argument("--report", default=None, help="write <REPORT>.json and <REPORT>.csv summaries")
+    args = parser.parse_args(argv)
+
+    results = validate_directories(args.root, args.workers, args.report)
+    if len(results) == 0:
+        print("ERROR: no ERJ shapefiles found under "+args.root)
+        return 1
+    failed = 0
+    for result in results:
+        passed = result["error"] is None and len(result["violations"]) == 0
+        failed += not passed
+        print(("PASSED" if passed else "FAILED")+": "+result["file"]+" ("+str(result["rows"])+" rows, "+"{:.2f}".format(result["seconds"])+" s)")
+        if result["error"] is not None:
+            print("\t"+result["error"])
+        for violation in result["violations"]:
+            print("\t"+violation["message"])
+    print(str(len(results))+" files checked, "+str(failed)+" failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())